@@ -0,0 +1,54 @@
+"""
+Benchmark of batch compositing across an increasing number of worker processes, on synthetic frames
+held in memory so that decoding and writing do not get in the way. Run from the repository root:
+
+    $ python benchmarks/batch.py --workers 1,2,4,8
+
+Every run reports its frame rate, and its speedup and parallel efficiency relative to one worker.
+Throughput should scale roughly linearly until the workers outnumber the physical cores.
+
+@author: Elias Gabriel, Duncan Mazza
+@revision: v1.0
+"""
+import sys, os
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "../source/"))
+
+import argparse
+import time
+from api.batch_classes import ProcessingPool
+from api.cv_classes import SyntheticCapture
+from engine import RESOLUTIONS, make_face
+
+FRAMES = 240
+
+
+def measure(face, frames, workers):
+    """ Composites the frames with the given number of workers, returning the frame rate. """
+    with ProcessingPool(face, workers) as pool:
+        # Warm up the workers, and allocate the shared memory, before timing anything
+        for _ in pool.map(frames[:workers * pool.chunk]):
+            pass
+
+        start = time.perf_counter()
+        for _ in pool.map(frames):
+            pass
+        return len(frames) / (time.perf_counter() - start)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmarks batch compositing across worker processes.")
+    parser.add_argument("--workers", default="1,2,4,{}".format(os.cpu_count()), help="comma-separated worker counts")
+    parser.add_argument("--resolution", choices=RESOLUTIONS, default="1080p")
+    parser.add_argument("--frames", type=int, default=FRAMES)
+    args = parser.parse_args()
+
+    capture = SyntheticCapture(RESOLUTIONS[args.resolution])
+    frames = [capture.read()[1] for _ in range(args.frames)]
+    face = make_face((480, 360), "png")
+
+    baseline = None
+    for workers in sorted({int(w) for w in args.workers.split(",")}):
+        fps = measure(face, frames, workers)
+        baseline = baseline or fps
+        print("{:>3} workers | {:7.1f} fps | {:5.2f}x speedup | {:4.0%} efficiency".format(
+            workers, fps, fps / baseline, fps / baseline / workers))
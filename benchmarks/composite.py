@@ -0,0 +1,53 @@
+"""
+Micro-benchmark comparing the original mask-based PNG compositing against the in-place
+premultiplied blend, at common camera resolutions. Run from the repository root:
+
+    $ python benchmarks/composite.py
+
+@author: Elias Gabriel, Duncan Mazza
+@revision: v1.0
+"""
+import sys, os
+sys.path.append(os.path.join(os.path.dirname(__file__), "../source/"))
+
+import timeit
+import cv2
+import numpy as np
+from api.cv_classes import OverlayCache, composite
+
+RESOLUTIONS = {"480p": (640, 480), "720p": (1280, 720), "1080p": (1920, 1080)}
+REPEATS = 500
+
+
+def legacy(frame, face, y1, y2, x1, x2):
+    """ The original compositing stage, with four full-ROI temporaries per frame. """
+    roi = frame[y1:y2, x1:x2]
+    mask = face[:, :, 3]
+    mask_inv = cv2.bitwise_not(mask)
+    frame_bg = cv2.bitwise_and(roi, roi, mask=mask_inv)
+    face_fg = cv2.bitwise_and(face, face, mask=mask)
+    dst = cv2.add(frame_bg, face_fg[:, :, :3])
+    frame[y1:y2, x1:x2] = dst
+
+
+def run(name, width, height):
+    """ Times both compositing stages for a face one third of the frame height across. """
+    rng = np.random.default_rng(0)
+    frame = rng.integers(0, 256, (height, width, 3), dtype=np.uint8)
+    source = rng.integers(0, 256, (512, 384, 4), dtype=np.uint8)
+
+    # Size the face through the overlay cache, exactly as the engine would
+    face, alpha_inv = OverlayCache().get(source, height // 12)
+    raw = cv2.flip(cv2.resize(source, (face.shape[1], face.shape[0])), 1)
+    y1, x1 = (height - face.shape[0]) // 2, (width - face.shape[1]) // 2
+    y2, x2 = y1 + face.shape[0], x1 + face.shape[1]
+
+    old = timeit.timeit(lambda: legacy(frame, raw, y1, y2, x1, x2), number=REPEATS) / REPEATS
+    new = timeit.timeit(lambda: composite(frame[y1:y2, x1:x2], face, alpha_inv), number=REPEATS) / REPEATS
+    print("{:>6} | face {:>4}x{:<4} | legacy {:8.1f} us | premultiplied {:8.1f} us | {:5.2f}x".format(
+        name, face.shape[1], face.shape[0], old * 1e6, new * 1e6, old / new))
+
+
+if __name__ == "__main__":
+    for name, (width, height) in RESOLUTIONS.items():
+        run(name, width, height)
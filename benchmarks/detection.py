@@ -0,0 +1,71 @@
+"""
+Benchmark comparing full-frame ARUCO detection against the windowed tracking and downscaled
+detection modes of `MarkerDetector`, on a synthetic 1080p feed with a marker drifting across it,
+and against the colored dot tracking of `BlobDetector` on the same feed with a pair of red dots in
+place of the marker. Run from the repository root:
+
+    $ python benchmarks/detection.py
+
+@author: Elias Gabriel, Duncan Mazza
+@revision: v1.0
+"""
+import sys, os
+sys.path.append(os.path.join(os.path.dirname(__file__), "../source/"))
+
+import time
+import cv2
+import cv2.aruco as aruco
+import numpy as np
+from api.cv_classes import MarkerDetector, BlobDetector, BLOB_SPAN
+
+FRAMES = 300
+SIZE = (1920, 1080)
+MARKER = 120
+
+MODES = {
+    "full frame": dict(),
+    "tracking": dict(track=True),
+    "tracking, 0.5x": dict(track=True, scale=0.5),
+    "full frame, 0.5x": dict(scale=0.5),
+}
+
+
+def frames(blob=False):
+    """ Yields frames with a marker, or a pair of red dots, moving along a slow circular path. """
+    marker = cv2.cvtColor(aruco.drawMarker(aruco.Dictionary_get(aruco.DICT_6X6_250), 7, MARKER),
+                          cv2.COLOR_GRAY2BGR)
+    frame = np.full((SIZE[1], SIZE[0], 3), 200, np.uint8)
+
+    for i in range(FRAMES):
+        x = int(SIZE[0] / 2 + 500 * np.cos(i / 40))
+        y = int(SIZE[1] / 2 + 300 * np.sin(i / 40))
+        current = frame.copy()
+        if blob:
+            # Space the dots so that they stand for a marker of the same size
+            for dot_y in (y + MARKER // 2 - int(MARKER * BLOB_SPAN / 2), y + MARKER // 2 + int(MARKER * BLOB_SPAN / 2)):
+                cv2.circle(current, (x + MARKER // 2, dot_y), MARKER // 8, (0, 0, 255), -1)
+            yield current
+            continue
+        # Surround the marker with a white quiet zone, as printed markers would have
+        cv2.rectangle(current, (x - 20, y - 20), (x + MARKER + 20, y + MARKER + 20), (255, 255, 255), -1)
+        current[y:y + MARKER, x:x + MARKER] = marker
+        yield current
+
+
+def run(name, detector, feed):
+    """ Times a detector over every frame of the feed, and prints its detection rate. """
+    start = time.perf_counter()
+    for frame in feed:
+        detector.detect(frame)
+    elapsed = (time.perf_counter() - start) / FRAMES
+
+    print("{:>17} | {:7.2f} ms/frame | detection rate {:6.1%} | full searches {:4d}".format(
+        name, elapsed * 1e3, detector.found / detector.frames, detector.full_searches))
+
+
+if __name__ == "__main__":
+    feed = list(frames())
+    for name, options in MODES.items():
+        run(name, MarkerDetector(**options), feed)
+
+    run("blob", BlobDetector(), list(frames(blob=True)))
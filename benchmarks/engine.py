@@ -0,0 +1,175 @@
+"""
+Offline benchmark of the full processing engine, from reading a frame to encoding it, driven by
+synthetic or recorded frames so that it runs on a headless machine without a camera. Run from the
+repository root:
+
+    $ python benchmarks/engine.py --output results.json
+    $ python benchmarks/engine.py --baseline results.json
+    $ python benchmarks/engine.py --video recording.mp4
+
+Every case reports its frame rate, the distribution of per-frame latencies, and the peak number of
+bytes allocated while processing a frame, as traced by `tracemalloc` in a separate pass (NumPy and
+OpenCV allocate their arrays through the traced allocator). It also reports how many frames were
+encoded, and how many reused the previous encoding because nothing had changed. Since the marker
+moves on every frame, any reuse in a case with a marker means a stale frame was served, and the
+script exits with an error. Since reusing an encoding skips most of the work and allocation of a frame,
+`--encode-all` turns that off, to measure every frame at its full cost. With `--baseline`, the frame rate of every case is compared against a
+previous run, and the script also exits with an error if any case regressed by more than the tolerance.
+
+@author: Elias Gabriel, Duncan Mazza
+@revision: v1.0
+"""
+import sys, os
+sys.path.append(os.path.join(os.path.dirname(__file__), "../source/"))
+
+import argparse
+import itertools
+import json
+import platform
+import time
+import tracemalloc
+import cv2
+import numpy as np
+from api.cv_classes import ProcessingEngine
+from api.metrics_classes import metrics
+
+RESOLUTIONS = {"480p": (640, 480), "720p": (1280, 720), "1080p": (1920, 1080)}
+FACES = {"small": (480, 360), "large": (4032, 3024)}  # (height, width) of the uploaded face
+FORMATS = ("png", "jpeg")
+WARMUP = 10
+FRAMES = 120
+ALLOCATION_FRAMES = 20
+
+
+def make_face(size, fmt):
+    """ Generates a face of the given size, with an alpha channel if it is a PNG. """
+    height, width = size
+    face = np.random.default_rng(0).integers(0, 256, (height, width, 4 if fmt == "png" else 3), dtype=np.uint8)
+    if fmt == "png":
+        # Give the face a soft, partially transparent edge, like a cut-out portrait
+        alpha = np.zeros((height, width), np.uint8)
+        cv2.ellipse(alpha, (width // 2, height // 2), (width * 2 // 5, height * 2 // 5), 0, 0, 360, 255, -1)
+        face[:, :, 3] = cv2.GaussianBlur(alpha, (0, 0), max(1, width // 50))
+    return face
+
+
+def measure(engine, frames=FRAMES):
+    """ Processes frames with the given engine, returning its frame rate and latency distribution. """
+    for _ in range(WARMUP):
+        engine.get_frame()
+
+    latencies = np.empty(frames)
+    encoded, reused = engine.encoder.encoded, engine.encoder.reused
+    start = time.perf_counter()
+    for i in range(frames):
+        frame_start = time.perf_counter()
+        engine.get_frame()
+        latencies[i] = time.perf_counter() - frame_start
+    elapsed = time.perf_counter() - start
+    encoded, reused = engine.encoder.encoded - encoded, engine.encoder.reused - reused
+
+    # Trace allocations separately, since tracing slows everything else down
+    tracemalloc.start()
+    peaks = []
+    for _ in range(ALLOCATION_FRAMES):
+        tracemalloc.reset_peak()
+        before = tracemalloc.get_traced_memory()[0]
+        engine.get_frame()
+        peaks.append(tracemalloc.get_traced_memory()[1] - before)
+    tracemalloc.stop()
+
+    p50, p95, p99 = np.quantile(latencies, (0.5, 0.95, 0.99)) * 1e3
+    return {
+        "fps": frames / elapsed,
+        "latency_ms": {"mean": latencies.mean() * 1e3, "p50": p50, "p95": p95, "p99": p99,
+                       "max": latencies.max() * 1e3},
+        "allocated_bytes_per_frame": int(np.median(peaks)),
+        "encoded": encoded,
+        "reused": reused,
+    }
+
+
+def encode_all(engine):
+    """ Makes the engine encode every frame, rather than reusing the encoding of an unchanged one. """
+    engine.encoder.threshold = 0
+    return engine
+
+
+def synthetic_cases(perspective=False):
+    """ Yields the name and engine of every synthetic case in the benchmark matrix. """
+    for (res, size), (face_name, face_size), fmt, marker in itertools.product(
+            RESOLUTIONS.items(), FACES.items(), FORMATS, (True, False)):
+        engine = ProcessingEngine(source="synthetic", perspective=perspective, size=size, marker=marker)
+        engine.set_face(make_face(face_size, fmt))
+        name = "{}/{}-{}/{}".format(res, face_name, fmt, "marker" if marker else "no-marker")
+        yield name, engine
+
+
+def video_cases(path, perspective=False):
+    """ Yields the name and engine of every case replaying the given video. """
+    for (face_name, face_size), fmt in itertools.product(FACES.items(), FORMATS):
+        engine = ProcessingEngine(source="file", perspective=perspective, path=path)
+        engine.set_face(make_face(face_size, fmt))
+        yield "{}/{}-{}".format(os.path.basename(path), face_name, fmt), engine
+
+
+def compare(results, baseline, tolerance):
+    """ Prints the change in frame rate of every case against a baseline, returning the names of
+    the cases that regressed by more than the tolerance. """
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        change = result["fps"] / baseline[name]["fps"] - 1
+        flag = ""
+        if change < -tolerance:
+            regressions.append(name)
+            flag = "  REGRESSION"
+        print("{:<36} {:8.1f} fps -> {:8.1f} fps ({:+6.1%}){}".format(
+            name, baseline[name]["fps"], result["fps"], change, flag))
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmarks the processing engine offline.")
+    parser.add_argument("--video", help="replay a recorded video instead of synthetic frames")
+    parser.add_argument("--output", help="write the results to a JSON file")
+    parser.add_argument("--baseline", help="compare against the results of a previous run")
+    parser.add_argument("--tolerance", type=float, default=0.1, help="allowed fractional drop in frame rate")
+    parser.add_argument("--frames", type=int, default=FRAMES, help="number of frames timed per case")
+    parser.add_argument("--perspective", action="store_true", help="warp the face onto the plane of the marker")
+    parser.add_argument("--encode-all", action="store_true", help="encode every frame, even if it is unchanged")
+    args = parser.parse_args()
+
+    # Measure the engine itself, not its profiling
+    metrics.enabled = False
+
+    results = {}
+    cases = video_cases(args.video, args.perspective) if args.video else synthetic_cases(args.perspective)
+    for name, engine in cases:
+        if args.encode_all:
+            encode_all(engine)
+        results[name] = measure(engine, args.frames)
+        engine.release()
+        print("{:<36} {:8.1f} fps | p50 {:6.2f} ms | p99 {:6.2f} ms | {:>9,} B/frame | {:>4} encoded, {:>4} reused"
+              .format(name, results[name]["fps"], results[name]["latency_ms"]["p50"],
+                      results[name]["latency_ms"]["p99"], results[name]["allocated_bytes_per_frame"],
+                      results[name]["encoded"], results[name]["reused"]))
+
+    # The marker moves on every synthetic frame, so none of them should reuse the previous encoding
+    stale = [name for name, result in results.items()
+             if not args.video and not name.endswith("/no-marker") and result["reused"]]
+    if stale:
+        sys.exit("{} case(s) served stale frames of a moving marker: {}".format(len(stale), ", ".join(stale)))
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"machine": {"platform": platform.platform(), "python": platform.python_version(),
+                                   "opencv": cv2.__version__, "cpus": os.cpu_count()},
+                       "results": results}, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f)["results"], args.tolerance)
+        if regressions:
+            sys.exit("{} case(s) regressed by more than {:.0%}.".format(len(regressions), args.tolerance))
@@ -0,0 +1,250 @@
+"""
+Load test of the whole web application with many concurrent viewers. The server runs in its own
+process, with a synthetic stand-in for the camera and either an in-process fake Redis (the default,
+which requires `fakeredis`) or a local Redis server. The camera shows a grid of markers, one for every
+client, since each session is allocated a marker of its own. Simulated clients then walk through the
+upload, marker, eye, capture and show steps at once, reading the MJPEG stream for a fixed duration.
+Run from the repository root:
+
+    $ python benchmarks/load.py --clients 1,4,16,64 --output load.json
+
+For every number of clients, it reports the frame rate and time to first frame delivered to each
+client, and the CPU usage and resident memory of the server and its worker processes, read from
+`/proc` (so Linux only).
+
+@author: Elias Gabriel, Duncan Mazza
+@revision: v1.0
+"""
+import sys, os
+SOURCE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "../source/")
+sys.path.append(SOURCE)
+
+import argparse
+import http.client
+import json
+import re
+import subprocess
+import threading
+import time
+import cv2
+import numpy as np
+
+DURATION = 10  # seconds each client reads its stream for
+BOUNDARY = b'--frame\r\n'
+JPEG_END = b'\xff\xd9\r\n'
+
+
+def serve(port, size, fps, fake_redis, asynchronous, workers, markers):
+    """ Runs the web application with a synthetic camera showing the given number of markers, which are
+    the lowest IDs and so the ones allocated to that many clients. Called in the server process. """
+    from api.web_classes import WebApplication
+    from api.cv_classes import SyntheticCapture
+    import app as routes
+
+    redis = None
+    if fake_redis:
+        import fakeredis
+        redis = fakeredis.FakeRedis()
+
+    # Flask looks for its templates relative to the working directory
+    os.chdir(SOURCE)
+    app = WebApplication("cropmeon", camera=lambda: SyntheticCapture(size, marker_id=range(markers), fps=fps),
+                         redis=redis, workers=workers)
+    app.route(routes.ROUTES)
+    app.listen(port=port, asynchronous=asynchronous)
+
+
+class Client:
+    """
+    A simulated user, which keeps its own session cookie and walks through the whole application.
+    """
+
+    def __init__(self, port, face, duration=DURATION):
+        self.port = port
+        self.face = face
+        self.duration = duration
+        self.cookie = None
+        self.frames = 0
+        self.elapsed = 0.0
+        self.first_frame = None  # seconds from requesting the stream to receiving its first frame
+        self.error = None
+
+    def request(self, method, url, body=None, headers=None):
+        """ Sends a request with the session cookie, returning the open response. """
+        connection = http.client.HTTPConnection("127.0.0.1", self.port, timeout=30)
+        headers = dict(headers or {})
+        if self.cookie:
+            headers["Cookie"] = self.cookie
+        connection.request(method, url, body, headers)
+        response = connection.getresponse()
+
+        cookie = response.getheader("Set-Cookie")
+        if cookie:
+            self.cookie = cookie.split(";")[0]
+        return response
+
+    def upload(self):
+        """ Uploads the face as a multipart form. """
+        boundary = "oncropload"
+        body = (("--{0}\r\nContent-Disposition: form-data; name=\"images[]\"; filename=\"face.png\"\r\n"
+                 "Content-Type: image/png\r\n\r\n").format(boundary).encode() + self.face +
+                "\r\n--{0}--\r\n".format(boundary).encode())
+        self.request("POST", "/upload", body, {"Content-Type": "multipart/form-data; boundary=" + boundary}).read()
+
+    def watch(self, stream):
+        """ Reads the MJPEG stream for the configured duration, counting the frames received. """
+        start = time.perf_counter()
+        response = self.request("GET", "/eye?stream=" + stream)
+        if response.status == 302:  # asynchronous streams are served from another URL
+            response.read()
+            response = self.request("GET", response.getheader("Location"))
+
+        buffer = b''
+        while time.perf_counter() - start < self.duration:
+            chunk = response.read1(65536)
+            if not chunk:
+                break
+            buffer += chunk
+
+            # Count every complete part, and keep whatever follows the last one
+            while True:
+                begin = buffer.find(BOUNDARY)
+                end = buffer.find(JPEG_END, begin)
+                if begin < 0 or end < 0:
+                    break
+                self.frames += 1
+                if self.first_frame is None:
+                    self.first_frame = time.perf_counter() - start
+                buffer = buffer[end + len(JPEG_END):]
+
+        self.elapsed = time.perf_counter() - start
+        response.close()
+
+    def run(self):
+        """ Walks through the application, capturing a photo halfway through watching the stream. """
+        try:
+            self.upload()
+            marker = re.search(r'src="(/markers/[^"]+)"', self.request("GET", "/marker").read().decode())
+            if marker:
+                self.request("GET", marker.group(1).replace("&amp;", "&")).read()
+            stream = re.search(r'stream=([\w-]+)', self.request("GET", "/snapshot").read().decode()).group(1)
+
+            watcher = threading.Thread(target=self.watch, args=(stream,))
+            watcher.start()
+            time.sleep(self.duration / 2)
+
+            self.request("POST", "/capture", "stream=" + stream,
+                         {"Content-Type": "application/x-www-form-urlencoded"}).read()
+            image = re.search(r'src="(/image/\w+)"', self.request("GET", "/show").read().decode())
+            if image:
+                self.request("GET", image.group(1)).read()
+
+            watcher.join()
+        except Exception as e:
+            self.error = repr(e)
+
+    @property
+    def fps(self):
+        """ The frame rate delivered to this client. """
+        return self.frames / self.elapsed if self.elapsed else 0.0
+
+
+def server_usage(pid):
+    """ Returns the total CPU seconds used by a process and its children, such as engine workers, and
+    their combined resident memory in bytes. """
+    cpu = rss = 0
+    for child in os.listdir("/proc"):
+        try:
+            with open("/proc/{}/stat".format(child)) as f:
+                fields = f.read().rsplit(")", 1)[1].split()
+            if child != str(pid) and fields[1] != str(pid):
+                continue
+            cpu += (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+
+            with open("/proc/{}/status".format(child)) as f:
+                rss += next(int(line.split()[1]) * 1024 for line in f if line.startswith("VmRSS"))
+        except (OSError, ValueError, StopIteration):
+            continue  # not a process, or one that has just exited
+    return cpu, rss
+
+
+def run(pid, port, count, duration):
+    """ Runs the given number of clients at once, returning a summary of their experience. """
+    face = cv2.imencode('.png', np.random.default_rng(0).integers(0, 256, (480, 360, 4), dtype=np.uint8))[1].tobytes()
+    clients = [Client(port, face, duration) for _ in range(count)]
+    threads = [threading.Thread(target=c.run) for c in clients]
+
+    cpu_start, _ = server_usage(pid)
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - start
+    cpu_end, rss = server_usage(pid)
+
+    fps = np.array([c.fps for c in clients])
+    first = np.array([c.first_frame for c in clients if c.first_frame is not None])
+    return {
+        "clients": count,
+        "errors": [c.error for c in clients if c.error],
+        "fps": {"mean": fps.mean(), "min": fps.min(), "max": fps.max()},
+        "first_frame_s": {"mean": first.mean(), "max": first.max()} if len(first) else None,
+        "server_cpu_percent": 100 * (cpu_end - cpu_start) / elapsed,
+        "server_rss_bytes": rss,
+    }
+
+
+def wait_for(port, timeout=30):
+    """ Waits for the server to accept connections. """
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            http.client.HTTPConnection("127.0.0.1", port, timeout=1).request("GET", "/")
+            return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError("The server did not start within {} seconds.".format(timeout))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load tests the web application.")
+    parser.add_argument("--clients", default="1,4,16", help="comma-separated numbers of concurrent clients")
+    parser.add_argument("--duration", type=float, default=DURATION, help="seconds each client watches for")
+    parser.add_argument("--port", type=int, default=8181)
+    parser.add_argument("--width", type=int, default=1280)
+    parser.add_argument("--height", type=int, default=720)
+    parser.add_argument("--fps", type=float, default=30, help="frame rate of the synthetic camera")
+    parser.add_argument("--redis", choices=("fake", "local"), default="fake")
+    parser.add_argument("--asynchronous", action="store_true", help="serve streams from an event loop")
+    parser.add_argument("--workers", type=int, default=0, help="run the engines in this many worker processes")
+    parser.add_argument("--output", help="write the results to a JSON file")
+    parser.add_argument("--serve", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve:
+        serve(args.port, (args.width, args.height), args.fps, args.redis == "fake", args.asynchronous,
+              args.workers, max(int(c) for c in args.clients.split(",")))
+        sys.exit()
+
+    # Start the server in its own process, so that its CPU and memory usage can be measured alone
+    server = subprocess.Popen([sys.executable, os.path.abspath(__file__), "--serve", *sys.argv[1:]],
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        wait_for(args.port)
+        results = []
+        for count in (int(c) for c in args.clients.split(",")):
+            result = run(server.pid, args.port, count, args.duration)
+            results.append(result)
+            print("{:>4} clients | {:6.1f} fps/client (min {:5.1f}) | first frame {:5.2f} s | "
+                  "server {:6.1f}% CPU, {:7.1f} MB | {} errors".format(
+                      count, result["fps"]["mean"], result["fps"]["min"],
+                      result["first_frame_s"]["mean"] if result["first_frame_s"] else float("nan"),
+                      result["server_cpu_percent"], result["server_rss_bytes"] / 2 ** 20, len(result["errors"])))
+    finally:
+        server.terminate()
+        server.wait()
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
@@ -0,0 +1,61 @@
+"""
+Micro-benchmark of the per-frame cost of placing the face in perspective, against the upright
+placement, at common camera resolutions. Run from the repository root:
+
+    $ python benchmarks/perspective.py
+
+Each resolution reports the upright blend, a fresh warp of the face onto a tilted marker followed by
+the blend, and the same when the marker has barely moved and the last warp is reused.
+
+@author: Elias Gabriel, Duncan Mazza
+@revision: v1.0
+"""
+import sys, os
+sys.path.append(os.path.join(os.path.dirname(__file__), "../source/"))
+
+import timeit
+import numpy as np
+from api.cv_classes import MarkerTrack, FaceWarper, composite
+from api.metrics_classes import metrics
+from composite import RESOLUTIONS, REPEATS
+from engine import make_face
+
+TILT = 0.25  # fraction by which the far edge of the marker is foreshortened
+
+
+def run(name, width, height):
+    """ Times both placements for a marker one twelfth of the frame height across. """
+    frame = np.random.default_rng(0).integers(0, 256, (height, width, 3), dtype=np.uint8)
+    track = MarkerTrack(make_face((512, 384), "png"))
+
+    # A marker in the middle of the frame, turned away from the camera about its vertical axis
+    size = height / 12
+    x, y = width / 2, height / 2
+    track.marker = np.float32([[x - size / 2, y - size / 2], [x + size / 2, y - size / 2 * (1 - TILT)],
+                               [x + size / 2, y + size / 2 * (1 - TILT)], [x - size / 2, y + size / 2]])
+    pose = (x, y, size)
+    quad = track.face_quad(pose)
+    x1, y1 = (int(v) for v in np.floor(quad.min(axis=0)))
+    x2, y2 = (int(v) for v in np.ceil(quad.max(axis=0)))
+    overlay = track.overlays.get(track.face, size)
+
+    def upright():
+        face, alpha_inv = track.overlays.get(track.face, size)
+        top, left = int(y) - face.shape[0] // 2, int(x) - face.shape[1] // 2
+        composite(frame[top:top + face.shape[0], left:left + face.shape[1]], face, alpha_inv)
+
+    def warped(warper):
+        (wx1, wy1, wx2, wy2), face, alpha_inv = warper.warp(overlay, track.face_quad(pose), (x1, y1, x2, y2))
+        composite(frame[wy1:wy2, wx1:wx2], face, alpha_inv)
+
+    fresh, reused = FaceWarper(threshold=0), FaceWarper()
+    times = [timeit.timeit(fn, number=REPEATS) / REPEATS * 1e6
+             for fn in (upright, lambda: warped(fresh), lambda: warped(reused))]
+    print("{:>6} | upright {:8.1f} us | warped {:8.1f} us ({:+8.1f}) | reused {:8.1f} us ({:+8.1f})".format(
+        name, times[0], times[1], times[1] - times[0], times[2], times[2] - times[0]))
+
+
+if __name__ == "__main__":
+    metrics.enabled = False
+    for name, (width, height) in RESOLUTIONS.items():
+        run(name, width, height)
@@ -0,0 +1,164 @@
+"""
+Benchmark of how quickly the web application starts, and how quickly it then serves its ordinary pages.
+The server is launched in its own process, as it would be in production, with either an in-process fake
+Redis (the default, which requires `fakeredis`) or a local Redis server. Run from the repository root:
+
+    $ python benchmarks/startup.py --output startup.json
+    $ python benchmarks/startup.py --eager
+    $ python benchmarks/startup.py --session-cache
+
+Every run reports the time from launching the server to its first response, and whether OpenCV had
+been loaded by then (read from `/proc`, so Linux only). Once it is up, a client uploads a face, and the
+latency of the index page, a static file and the marker page are then measured over many requests,
+each on a new connection with the client's session cookie. With `--eager`, OpenCV is imported before
+the application is created, as it was before the computer vision classes were imported on demand.
+
+@author: Elias Gabriel, Duncan Mazza
+@revision: v1.0
+"""
+import sys, os
+SOURCE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "../source/")
+sys.path.append(SOURCE)
+
+# Only the standard library is imported here, since the server process runs this script too
+import argparse
+import http.client
+import json
+import random
+import statistics
+import struct
+import subprocess
+import time
+import zlib
+
+RUNS = 5  # number of times the server is started
+REQUESTS = 200  # number of timed requests to each page
+WARMUP = 10
+PAGES = ("/", "/static/styles.css", "/marker")
+
+
+def serve(port, fake_redis, eager, session_cache):
+    """ Runs the web application. Called in the server process. """
+    if eager:
+        import cv2
+
+    from api.web_classes import WebApplication
+    import app as routes
+
+    redis = None
+    if fake_redis:
+        import fakeredis
+        redis = fakeredis.FakeRedis()
+
+    # Flask looks for its templates relative to the working directory
+    os.chdir(SOURCE)
+    app = WebApplication("cropmeon", redis=redis, session_cache=session_cache)
+    app.route(routes.ROUTES)
+    app.listen(port=port)
+
+
+def make_face(width=360, height=480):
+    """ Encodes a PNG of random RGBA noise, without needing OpenCV. """
+    def chunk(kind, data):
+        return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data))
+
+    rows = random.Random(0).randbytes(width * height * 4)
+    raw = b"".join(b"\0" + rows[y * width * 4:(y + 1) * width * 4] for y in range(height))
+    return (b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 6, 0, 0, 0)) +
+            chunk(b"IDAT", zlib.compress(raw)) + chunk(b"IEND", b""))
+
+
+def opencv_loaded(pid):
+    """ Whether the given process has loaded OpenCV's native library. """
+    with open("/proc/{}/maps".format(pid)) as f:
+        return any("cv2" in line for line in f)
+
+
+def request(port, method, url, body=None, headers=None):
+    """ Sends a request, returning the response once it has been read in full. """
+    connection = http.client.HTTPConnection("127.0.0.1", port, timeout=30)
+    connection.request(method, url, body, headers or {})
+    response = connection.getresponse()
+    response.read()
+    connection.close()
+    return response
+
+
+def start(command, port, timeout=60):
+    """ Launches the server, returning its process and the seconds until its first successful response. """
+    launched = time.perf_counter()
+    server = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            if request(port, "GET", "/").status == 200:
+                return server, time.perf_counter() - launched
+        except OSError:
+            time.sleep(0.005)
+    server.terminate()
+    raise RuntimeError("The server did not start within {} seconds.".format(timeout))
+
+
+def latencies(port, count):
+    """ Uploads a face, then measures the latency of every page with the resulting session over the given
+    number of requests, after warming each up. """
+    boundary = "oncropstartup"
+    body = (("--{0}\r\nContent-Disposition: form-data; name=\"images[]\"; filename=\"face.png\"\r\n"
+             "Content-Type: image/png\r\n\r\n").format(boundary).encode() + make_face() +
+            "\r\n--{0}--\r\n".format(boundary).encode())
+    response = request(port, "POST", "/upload", body, {"Content-Type": "multipart/form-data; boundary=" + boundary})
+    cookie = response.getheader("Set-Cookie", "").split(";")[0]
+
+    results = {}
+    for page in PAGES:
+        times = []
+        for i in range(-WARMUP, count):
+            begin = time.perf_counter()
+            request(port, "GET", page, headers={"Cookie": cookie})
+            if i >= 0:
+                times.append((time.perf_counter() - begin) * 1e3)
+        percentiles = statistics.quantiles(times, n=100)
+        results[page] = {"mean": statistics.fmean(times), "p50": percentiles[49], "p99": percentiles[98]}
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmarks the startup and page latency of the web application.")
+    parser.add_argument("--runs", type=int, default=RUNS, help="number of times the server is started")
+    parser.add_argument("--requests", type=int, default=REQUESTS, help="number of timed requests to each page")
+    parser.add_argument("--port", type=int, default=8182)
+    parser.add_argument("--redis", choices=("fake", "local"), default="fake")
+    parser.add_argument("--eager", action="store_true", help="import OpenCV before creating the application")
+    parser.add_argument("--session-cache", action="store_true", help="serve read-only sessions from memory")
+    parser.add_argument("--output", help="write the results to a JSON file")
+    parser.add_argument("--serve", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve:
+        serve(args.port, args.redis == "fake", args.eager, args.session_cache)
+        sys.exit()
+
+    command = [sys.executable, os.path.abspath(__file__), "--serve", *sys.argv[1:]]
+    starts = []
+    for run in range(args.runs):
+        server, elapsed = start(command, args.port)
+        try:
+            loaded = opencv_loaded(server.pid)
+            starts.append(elapsed)
+            print("start {:>2} | first response {:6.3f} s | OpenCV {}".format(
+                run + 1, elapsed, "loaded" if loaded else "not loaded"))
+
+            # Time the pages on the last run only
+            if run == args.runs - 1:
+                pages = latencies(args.port, args.requests)
+        finally:
+            server.terminate()
+            server.wait()
+
+    for page, result in pages.items():
+        print("{:<20} | p50 {:6.2f} ms | p99 {:6.2f} ms".format(page, result["p50"], result["p99"]))
+    print("first response: median {:.3f} s, min {:.3f} s".format(statistics.median(starts), min(starts)))
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"first_response_s": starts, "opencv_loaded": loaded, "latency_ms": pages}, f, indent=2)
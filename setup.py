@@ -5,7 +5,6 @@ An simple script to install all the runtime dependencies required of Oncrop.
 @revision: v1.0
 """
 import subprocess
-from source.api.cv_classes import ProcessingEngine
 
 
 def cmd(command, *args):
@@ -16,7 +15,7 @@ def cmd(command, *args):
 # Execute if run directly from the command line
 if __name__ == "__main__":
 	print(" ===== Installing Python dependencies...")
-	cmd("pip", "install", "opencv-contrib-python Flask Flask-Session redis")
+	cmd("pip", "install", "opencv-contrib-python Flask Flask-Session~=0.8.0 redis uvicorn a2wsgi")
 
 	# Download the latest Redis source
 	print("\n ===== Downloading Redis...")
@@ -34,7 +33,4 @@ if __name__ == "__main__":
 	print("\n ===== Cleaning up artifacts...")
 	cmd("rm -r ./tmp")
 
-	print("\n ===== Generating AURCO markers...")
-	ProcessingEngine.generate_markers(10)
-
 	print("\nDependency installation complete!")
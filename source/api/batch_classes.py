@@ -0,0 +1,229 @@
+"""
+Contains the classes used to composite faces into recorded videos and sets of photos offline.
+
+@author: Elias Gabriel, Duncan Mazza
+@revision: v1.0
+"""
+import os
+import queue
+import threading
+from collections import deque
+from multiprocessing import shared_memory
+import cv2
+import numpy as np
+from .cv_classes import ProcessingEngine
+from .worker_classes import SharedFrames, spawn_workers
+
+CHUNK_FRAMES = 4  # number of consecutive video frames handed to the same worker at once
+POLL_INTERVAL = 1.0  # seconds between checks that the workers are still alive while waiting on them
+IMAGE_TYPES = (".jpg", ".jpeg", ".png", ".bmp", ".tif", ".tiff", ".webp")  # extensions read from directories
+VIDEO_CODEC = "mp4v"  # FourCC of the videos written out
+
+
+def _work(face, perspective, tracker, tasks, results):
+    """ Composites the face, or the faces mapped to each marker ID, into frames in shared memory, in place,
+    until sent None. Runs in every worker process. """
+    engine = ProcessingEngine(source=None, perspective=perspective, tracker=tracker)
+    if isinstance(face, dict):
+        engine.set_faces(face)
+    else:
+        engine.set_face(face)
+    slots = SharedFrames()  # every slot attached to so far, reattached whenever it is reallocated
+
+    for slot, name, shape, index, reset in iter(tasks.get, None):
+        slots.attach(slot, name, shape)
+        error = None
+        try:
+            if reset:
+                engine.reset()
+            slots.process(slot, engine)
+        except Exception as e:
+            error = repr(e)
+        results.put((index, slot, error))
+
+    slots.close()
+
+
+class ProcessingPool:
+    """
+    Composites a face into long sequences of frames across a pool of worker processes, each running
+    its own processing engine. Frames are passed to and from the workers through a small set of
+    reusable slots in shared memory, and are composited there in place, so no frame is ever pickled.
+    Instead of a single face, a mapping from marker IDs to faces places a different face on each marker.
+
+    Consecutive frames are handed to the same worker in chunks, so that its motion filter follows
+    continuous motion, and the filters are reset at the start of every chunk. The processed frames are
+    yielded in their original order, however the work was spread out.
+    """
+
+    def __init__(self, face, workers=None, chunk=CHUNK_FRAMES, perspective=False, tracker="aruco"):
+        self.workers = workers or os.cpu_count()
+        self.chunk = chunk
+        self.slots = [None] * (self.workers + 1) * chunk  # (block, size) of each slot, allocated on use
+        self.frames = 0  # number of frames processed so far
+
+        self.tasks, self.results, self.processes = spawn_workers(self.workers, _work, face, perspective, tracker)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        """ Stops the workers, and frees the shared memory. """
+        for tasks in self.tasks:
+            tasks.put(None)
+        for process in self.processes:
+            process.join()
+
+        for slot in self.slots:
+            if slot is not None:
+                slot[0].close()
+                slot[0].unlink()
+        self.slots = [None] * len(self.slots)
+
+    def _view(self, slot, shape):
+        """ Returns an array of the given shape backed by a slot, reallocating the slot if it is too small. """
+        size = int(np.prod(shape))
+        if self.slots[slot] is None or self.slots[slot][1] < size:
+            if self.slots[slot] is not None:
+                self.slots[slot][0].close()
+                self.slots[slot][0].unlink()
+            self.slots[slot] = (shared_memory.SharedMemory(create=True, size=size), size)
+        return np.ndarray(shape, np.uint8, self.slots[slot][0].buf)
+
+    def map(self, frames, continuous=True):
+        """ Composites the face into every BGR frame of the given iterable, yielding the processed frames
+        in order. If `continuous` is False, the frames are unrelated, like a set of photos, and are
+        each processed from scratch. The yielded frames live in shared memory, and are only valid
+        until the next one is requested. """
+        free = queue.Queue()
+        for slot in range(len(self.slots)):
+            free.put(slot)
+        shapes = {}  # index -> shape of every frame handed out and not yet yielded
+        stopped = threading.Event()
+        failure = []
+        dispatched = 0
+
+        def read():
+            """ Copies the frames into free slots and hands them out to the workers. """
+            nonlocal dispatched
+            try:
+                for index, frame in enumerate(frames):
+                    slot = free.get()
+                    if stopped.is_set():
+                        break
+                    self._view(slot, frame.shape)[:] = frame
+                    shapes[index] = frame.shape
+                    reset = not continuous or index % self.chunk == 0
+                    self.tasks[(index // self.chunk) % self.workers].put(
+                        (slot, self.slots[slot][0].name, frame.shape, index, reset))
+                    dispatched += 1
+            except Exception as e:
+                failure.append(e)
+            finally:
+                self.results.put((None, None, None))  # tell the collector that no more frames are coming
+
+        reader = threading.Thread(target=read, name="batch-reader", daemon=True)
+        reader.start()
+
+        reading = True
+        received = collected = 0
+        finished = {}  # index -> slot of the processed frames waiting for their turn
+        try:
+            while reading or received < dispatched:
+                result = self._collect()
+                if result is None:
+                    continue
+                index, slot, error = result
+                if index is None:
+                    reading = False
+                    continue
+
+                received += 1
+                if error is not None:
+                    raise RuntimeError("Frame {} could not be processed: {}".format(index, error))
+                finished[index] = slot
+
+                # Yield every frame that is now next in line, then hand its slot back to the reader
+                while collected in finished:
+                    slot = finished.pop(collected)
+                    yield np.ndarray(shapes.pop(collected), np.uint8, self.slots[slot][0].buf)
+                    collected += 1
+                    self.frames += 1
+                    free.put(slot)
+
+            if failure:
+                raise failure[0]
+        finally:
+            # Stop reading, and wait for the frames still in flight, since they hold on to their slots
+            stopped.set()
+            free.put(None)
+            reader.join()
+            while reading or received < dispatched:
+                result = self._collect()
+                if result is not None:
+                    reading = reading and result[0] is not None
+                    received += result[0] is not None
+
+    def _collect(self):
+        """ Waits briefly for a processed frame, returning its (index, slot, error), or None if there was
+        none. Raises a RuntimeError if a worker has died, since its frames will never come back. """
+        try:
+            return self.results.get(timeout=POLL_INTERVAL)
+        except queue.Empty:
+            if not all(process.is_alive() for process in self.processes):
+                raise RuntimeError("A worker process exited unexpectedly.")
+            return None
+
+    def process_video(self, path, output, codec=VIDEO_CODEC):
+        """ Composites the face into every frame of a video, writing the result to another video at the
+        same frame rate. Returns the number of frames written. """
+        capture = cv2.VideoCapture(path)
+        if not capture.isOpened():
+            raise ValueError("Unable to open the video `{}`.".format(path))
+        fps = capture.get(cv2.CAP_PROP_FPS) or 30
+
+        def frames():
+            """ Yields the frames of the video until it runs out. """
+            ok, frame = capture.read()
+            while ok:
+                yield frame
+                ok, frame = capture.read()
+
+        writer = None
+        written = 0
+        try:
+            for frame in self.map(frames()):
+                if writer is None:
+                    writer = cv2.VideoWriter(output, cv2.VideoWriter_fourcc(*codec), fps, frame.shape[1::-1])
+                writer.write(frame)
+                written += 1
+        finally:
+            capture.release()
+            if writer is not None:
+                writer.release()
+        return written
+
+    def process_images(self, directory, output):
+        """ Composites the face into every image in a directory, writing each result to another directory
+        under the same name. Files that cannot be read as images are skipped. Returns the number of
+        images written. """
+        os.makedirs(output, exist_ok=True)
+        names = deque()  # names of the images handed out, in order
+
+        def images():
+            """ Yields every readable image in the directory, in name order. """
+            for name in sorted(os.listdir(directory)):
+                if os.path.splitext(name)[1].lower() in IMAGE_TYPES:
+                    image = cv2.imread(os.path.join(directory, name), cv2.IMREAD_COLOR)
+                    if image is not None:
+                        names.append(name)
+                        yield image
+
+        written = 0
+        for image in self.map(images(), continuous=False):
+            cv2.imwrite(os.path.join(output, names.popleft()), image)
+            written += 1
+        return written
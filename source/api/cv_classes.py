@@ -6,24 +6,1231 @@ Contains all the classes used for computer vision and backend processing.
 """
 import cv2
 import cv2.aruco as aruco
-import os
+import time
+import hashlib
+import warnings
+import threading
+import numpy as np
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from .metrics_classes import metrics
 
 FACE_SCL = 4  # coefficient to scale the size of the face relative to the width of the aruco code
+WIDTH_STEP = 4  # granularity (in pixels) to which marker widths are quantized before resizing the face
+CACHE_SIZE = 16  # maximum number of resized face overlays kept in memory
+REMOTE_QUEUE = 2  # maximum number of remote frames waiting to be processed
+STREAM_IDLE_TIMEOUT = 10  # seconds a stream waits without a new frame, such as from a remote client, before ending
+TRACK_PADDING = 0.5  # fraction of the marker size searched around its last known position
+TRACK_MISSES = 3  # consecutive misses in the tracking window before searching the whole frame
+TRACK_REFRESH = 15  # frames between searches of the whole frame while tracking, so new markers are still found
+FILTER_ALPHA = 0.7  # weight given to the measured position by the motion filter
+FILTER_BETA = 0.3  # weight given to the measured velocity by the motion filter
+FILTER_DECAY = 0.8  # confidence lost by the motion filter for every predicted frame
+MIN_CONFIDENCE = 0.3  # confidence below which a predicted marker is considered lost
+DETECT_CONFIDENCE = 0.6  # confidence below which detection is forced, even on skipped frames
+DETECT_EVERY = 1  # run marker detection on every n-th frame, predicting the frames in between
+JPEG_QUALITY = 90  # default quality of the streamed JPEG frames
+JPEG_SUBSAMPLING = ("444", "422", "420")  # chroma subsampling modes the streamed JPEG frames can be encoded with
+ENCODER_THREADS = 4  # number of threads shared by all of the JPEG encoders
+THUMBNAIL_SIZE = (64, 48)  # size of the thumbnails compared to detect unchanged frames
+CHANGE_THRESHOLD = 6  # largest difference of any thumbnail pixel below which a frame is considered unchanged
+FACE_STORE_SIZE = 32  # maximum number of decoded faces kept in memory
+FACE_TTL = 60 * 60  # seconds a compressed face is kept in Redis
+FRAME_BUFFERS = 3  # number of reusable frames in each buffer pool, so a frame stays valid for two more reads
+HELD_FRAMES = 2  # number of frames handed out by a grabber that may still be in use by its consumer
+WARP_THRESHOLD = 1.0  # pixels the face's corners may move before it is warped again, rather than reused
+MAX_FRAME_SIZE = (1920, 1080)  # largest frame faces are drawn into, so FACE_SCL times the widest marker they fit
+FACE_MARGIN = 0.5  # fraction of a detected face's size kept around it on every side when cropping to it
+FACE_DETECT_SIZE = 640  # longest side (in pixels) of the copy of an upload that faces are detected in
+FACE_MIN_FRACTION = 0.1  # smallest face searched for in an upload, as a fraction of its shortest side
+PYRAMID_MIN_WIDTH = 64  # width (in pixels) below which faces are not halved any further for their pyramid
+BLOB_COLORS = (((0, 0, 240), (230, 230, 255)), ((0, 240, 0), (230, 255, 230)),  # (lower, upper) BGR bounds of
+               ((240, 0, 0), (255, 230, 230)))  # the red, green and blue dots tracked by the blob tracker
+BLOB_BITS = 5  # bits kept of each channel when classifying colors, so the lookup table has 2 ** 15 entries
+BLOB_SCALE = 0.5  # scale of the copy of the frame that colored dots are found in
+BLOB_MIN_AREA = 20  # smallest dot (in pixels of the full frame) considered a marker, rather than noise
+BLOB_FILL = 0.5  # smallest fraction of its bounding box that a dot must fill, since dots are round
+BLOB_SPAN = 3.0  # distance between a pair of dots, in widths of the marker the pair stands for
+BLOB_SMOOTHING = 4  # number of recent detections each pair of dots is averaged over
+MARKER_IDS = 250  # number of markers in the ARUCO dictionary, DICT_6X6_250
+MARKER_SIZE = 700  # default size (in pixels) of the rendered markers
+MARKER_SIZES = (16, 2048)  # smallest and largest sizes (in pixels) markers are rendered at
+MARKER_FORMATS = {"png": ".png", "jpeg": ".jpg", "jpg": ".jpg"}  # formats markers are rendered in, by name
+MARKER_CACHE_SIZE = 64  # maximum number of encoded markers kept in memory
+TOO_CLOSE = "You are too close to the frame"  # the text shown when the face would cover the whole frame
+SUBPIX_CRITERIA = (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_MAX_ITER, 10, 0.05)
+CHANNEL_SUM = np.float32([[1, 1, 1]])  # the transform adding up the channels of an image
+UNIT_SQUARE = np.float32([[0, 0], [1, 0], [1, 1], [0, 1]])  # the corners of a marker, in its own plane
+
+
+class FrameSignal:
+    """
+    The callbacks to run whenever a capture source has a new frame, so that a viewer served from an event
+    loop can wait for its next frame without holding a thread. Callbacks are run on the source's own
+    thread, so they should only hand the news over, such as with `loop.call_soon_threadsafe`.
+    """
+
+    def __init__(self):
+        self.callbacks = set()
+        self.lock = threading.Lock()
+
+    def watch(self, callback):
+        """ Runs the callback whenever there is a new frame, until unwatched. """
+        with self.lock:
+            self.callbacks.add(callback)
+
+    def unwatch(self, callback):
+        """ Stops running the callback, if it was being run. """
+        with self.lock:
+            self.callbacks.discard(callback)
+
+    def notify(self):
+        """ Runs every callback. """
+        with self.lock:
+            callbacks = tuple(self.callbacks)
+        for callback in callbacks:
+            callback()
 
 
 class ByteCapture:
     """
-    Serves as a wrapper for a given byte sequence. This class forms a bridge between raw data and
-    an abstracted processing engine. Currently it is not used - exists for future capabilities.
+    Serves as a capture device for frames pushed by a remote client, such as a phone's camera. Each
+    frame arrives as a JPEG-encoded byte sequence and waits in a small bounded queue, dropping the
+    oldest frames when the engine falls behind, until it is read and decoded.
     """
 
+    def __init__(self, max_queue=REMOTE_QUEUE):
+        self.queue = deque(maxlen=max_queue)
+        self.condition = threading.Condition()
+        self.signal = FrameSignal()
+        self.closed = False
+        self.received = self.dropped = self.decoded = 0
+        self.decode_time = self.decode_total = 0.0  # seconds spent decoding the last, and all, frames
+
+    @property
+    def depth(self):
+        """ The number of frames waiting to be decoded. """
+        return len(self.queue)
+
     def write(self, byte_seq):
-        """ Stores the given byte sequence within an instance attribute. """
-        self.bytes = byte_seq
+        """ Queues the given encoded frame, dropping the oldest one if the queue is full. """
+        with self.condition:
+            if len(self.queue) == self.queue.maxlen:
+                self.dropped += 1
+                metrics.count("oncrop_frames_dropped_total")
+            self.queue.append(byte_seq)
+            self.received += 1
+            self.condition.notify()
+        self.signal.notify()
+
+    def read(self, timeout=1.0):
+        """ Waits for the next queued frame and returns it decoded, in the same form as
+        `cv2.VideoCapture.read`. """
+        with self.condition:
+            self.condition.wait_for(lambda: self.queue or self.closed, timeout)
+            if not self.queue:
+                return False, None
+            byte_seq = self.queue.popleft()
+            backlog = bool(self.queue)
+
+        # Frames are only signaled as they arrive, so signal those still waiting as well
+        if backlog:
+            self.signal.notify()
+
+        # Decode straight from the received bytes, without copying them into a new array first
+        start = time.perf_counter()
+        frame = cv2.imdecode(np.frombuffer(byte_seq, np.uint8), cv2.IMREAD_COLOR)
+        self.decode_time = time.perf_counter() - start
+        self.decode_total += self.decode_time
+        self.decoded += 1
+        metrics.observe("decode", start)
+
+        return frame is not None, frame
+
+    def release(self):
+        """ Stops accepting frames, and wakes any waiting reader. """
+        with self.condition:
+            self.closed = True
+            self.queue.clear()
+            self.condition.notify_all()
+        self.signal.notify()
+
+
+def draw_marker(marker_id, size):
+    """ Renders the ARUCO marker with the given ID as a grayscale image, `size` pixels across. """
+    return aruco.drawMarker(aruco.Dictionary_get(aruco.DICT_6X6_250), marker_id, size)
+
+
+def draw_dots(marker_id, size):
+    """ Renders the pair of colored dots the blob tracker reads as the marker with the given ID, one above
+    the other on a white card, as a BGR image `size` pixels tall. """
+    lower, _ = BLOB_COLORS[marker_id]
+    color = tuple(255 if value == max(lower) else value for value in lower)  # the fully saturated color
+    card = np.full((size, size // 2, 3), 255, np.uint8)
+    radius = size // 10
+    for y in (2 * radius, size - 2 * radius):
+        cv2.circle(card, (size // 4, y), radius, color, -1, cv2.LINE_AA)
+    return card
+
+
+def marker_count(tracker="aruco"):
+    """ Returns the number of distinct markers the named tracker can tell apart, whose IDs count up from 0. """
+    if tracker == "aruco":
+        return MARKER_IDS
+    if tracker == "blob":
+        return len(BLOB_COLORS)
+    raise ValueError("Unknown tracker! Must be `aruco` or `blob`.")
+
+
+class MarkerRenderer:
+    """
+    Renders markers on demand, in any size and format, and keeps the encoded images of the most
+    recently requested ones in a bounded LRU. The markers are ARUCO markers, or pairs of colored dots
+    for the blob tracker. Each image is returned along with a strong ETag derived from its contents,
+    since a marker never changes once rendered.
+    """
+
+    def __init__(self, tracker="aruco", max_size=MARKER_CACHE_SIZE):
+        self.count = marker_count(tracker)
+        self.draw = draw_dots if tracker == "blob" else draw_marker
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = self.misses = 0
+
+    def render(self, marker_id, size=None, fmt="png"):
+        """ Returns the (bytes, etag) of the marker with the given ID, `size` pixels across (or the default
+        size), encoded in the named format. Raises a ValueError if the marker, size or format is not supported. """
+        size = MARKER_SIZE if size is None else size
+        if not 0 <= marker_id < self.count:
+            raise ValueError("Markers must have an ID between 0 and {}.".format(self.count - 1))
+        if not MARKER_SIZES[0] <= size <= MARKER_SIZES[1]:
+            raise ValueError("Markers must be between {} and {} pixels across.".format(*MARKER_SIZES))
+        if fmt not in MARKER_FORMATS:
+            raise ValueError("Markers can only be rendered as {}.".format(", ".join(MARKER_FORMATS)))
+
+        key = (marker_id, size, MARKER_FORMATS[fmt])
+        with self.lock:
+            if key in self.entries:
+                self.hits += 1
+                self.entries.move_to_end(key)
+                return self.entries[key]
+
+        self.misses += 1
+        image = cv2.imencode(key[2], self.draw(marker_id, size))[1].tobytes()
+        entry = (image, hashlib.sha1(image).hexdigest()[:16])
+        with self.lock:
+            self.entries[key] = entry
+            if len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+        return entry
+
+
+class FramePool:
+    """
+    A small ring of reusable frame buffers, so that capturing a frame writes into memory that was
+    allocated once instead of allocating a new full-size array every time. A buffer comes round again
+    after `size - 1` others have been taken, so a frame is only valid for that long.
+    """
+
+    def __init__(self, size=FRAME_BUFFERS):
+        self.buffers = [None] * size
+        self.index = 0
+
+    def take(self, busy=()):
+        """ Returns the next buffer in the ring that is not one of `busy`, or None if it has yet to be
+        allocated. Whatever was actually written to must be handed back with `put`. """
+        for _ in range(len(self.buffers)):
+            self.index = (self.index + 1) % len(self.buffers)
+            buffer = self.buffers[self.index]
+            if not any(buffer is frame for frame in busy):
+                return buffer
+        return None
+
+    def put(self, frame):
+        """ Keeps the frame written by the last `take` for reuse, in case a new one had to be allocated. """
+        self.buffers[self.index] = frame
+
+    def copy(self, frame):
+        """ Returns a copy of the given frame in the next buffer of the ring. """
+        buffer = self.take()
+        if buffer is None or buffer.shape != frame.shape:
+            buffer = np.empty_like(frame)
+        np.copyto(buffer, frame)
+        self.put(buffer)
+        return buffer
+
+
+class FileCapture:
+    """
+    Replays a recorded video as a capture device, rewinding to the beginning whenever it runs out.
+    Frames are decoded into a pool of reusable buffers, unless a buffer is given to read into.
+    """
+
+    def __init__(self, path):
+        self.capture = cv2.VideoCapture(path)
+        if not self.capture.isOpened():
+            raise ValueError("Unable to open the video `{}`.".format(path))
+        self.buffers = FramePool()
+
+    def read(self, frame=None):
+        """ Returns the next frame of the video, in the same form as `cv2.VideoCapture.read`. """
+        buffered = frame is None
+        if buffered:
+            frame = self.buffers.take()
+
+        ok, frame = self.capture.read(frame)
+        if not ok:
+            self.capture.set(cv2.CAP_PROP_POS_FRAMES, 0)
+            ok, frame = self.capture.read(frame)
+
+        if buffered and ok:
+            self.buffers.put(frame)
+        return ok, frame
+
+    def release(self):
+        """ Closes the video. """
+        self.capture.release()
+
+
+class SyntheticCapture:
+    """
+    Generates frames of a given size showing an ARUCO marker, surrounded by a white border, that
+    moves along a circular path around the center of the frame. Used to benchmark the engine without
+    a camera. If `marker_id` is a sequence of IDs, their markers move together in a grid. If `marker`
+    is False, the frames are blank. If `fps` is given, frames are only produced at that rate, like a
+    real camera. Frames are drawn into a pool of reusable buffers, unless a buffer is given to read into.
+    """
+
+    def __init__(self, size=(1280, 720), marker=True, marker_id=0, marker_size=None, period=120, fps=None):
+        self.interval = 1 / fps if fps else 0
+        self.deadline = time.monotonic()
+        width, height = size
+        self.background = np.full((height, width, 3), 160, np.uint8)
+        ids = [marker_id] if isinstance(marker_id, int) else list(marker_id)
+
+        # Lay the markers out in a square grid, with room for their borders, no taller than half the frame
+        self.columns = int(np.ceil(np.sqrt(len(ids))))
+        rows = int(np.ceil(len(ids) / self.columns))
+        self.marker_size = marker_size or min(height // 8, int(height / 2 / (1.5 * rows)))
+        self.spacing = self.marker_size * 3 // 2
+        self.extent = (self.spacing * (self.columns - 1) + self.marker_size,
+                       self.spacing * (rows - 1) + self.marker_size)  # (width, height) of the whole grid
+        self.markers = [cv2.cvtColor(draw_marker(i, self.marker_size), cv2.COLOR_GRAY2BGR)
+                        for i in ids] if marker else []
+        self.period = period  # number of frames taken to complete the path
+        self.index = 0
+        self.buffers = FramePool()
+
+    def position(self, index):
+        """ Returns the top left corner of the markers in the frame with the given index. """
+        height, width = self.background.shape[:2]
+        angle = 2 * np.pi * index / self.period
+        x = (width - self.extent[0]) / 2 + width / 4 * np.cos(angle)
+        y = (height - self.extent[1]) / 2 + height / 8 * np.sin(angle)
+        return int(x), int(y)
+
+    def read(self, frame=None):
+        """ Returns the next frame along the path, in the same form as `cv2.VideoCapture.read`. """
+        if self.interval:
+            self.deadline = max(self.deadline + self.interval, time.monotonic())
+            time.sleep(max(0, self.deadline - time.monotonic()))
+
+        if frame is None or frame.shape != self.background.shape:
+            frame = self.buffers.copy(self.background)
+        else:
+            np.copyto(frame, self.background)
+        left, top = self.position(self.index)
+        for i, marker in enumerate(self.markers):
+            x = left + i % self.columns * self.spacing
+            y = top + i // self.columns * self.spacing
+            border = self.marker_size // 6
+            size = self.marker_size
+            frame[y - border:y + size + border, x - border:x + size + border] = 255
+            frame[y:y + size, x:x + size] = marker
+
+        self.index += 1
+        return True, frame
+
+    def release(self):
+        """ Does nothing, since there is no device to release. """
+
+
+def face_pyramid(face, min_width=PYRAMID_MIN_WIDTH):
+    """ Returns a tuple of the face followed by successively halved copies of it, down to `min_width`, so
+    that overlays can be resized from the nearest level instead of from the full face. """
+    levels = [face]
+    while levels[-1].shape[1] // 2 >= min_width:
+        levels.append(cv2.pyrDown(levels[-1]))
+    return tuple(levels)
+
+
+def composite(roi, face, alpha_inv):
+    """ Blends a premultiplied face onto the given region of interest, writing directly into the
+    underlying frame. Both steps use OpenCV's saturating 8-bit arithmetic and allocate nothing. """
+    cv2.multiply(roi, alpha_inv, dst=roi, scale=1 / 255)  # attenuate the background by (1 - alpha)
+    cv2.add(roi, face, dst=roi)  # add the premultiplied foreground
+    return roi
+
+
+class FrameGrabber:
+    """
+    Owns a capture device and continuously reads from it on a background thread, keeping only the
+    most recent frame. Consumers always receive the newest frame, and frames that are replaced
+    before anyone reads them are counted as dropped, so latency stays bounded when processing falls
+    behind the camera. Frames are captured into a pool of reusable buffers, skipping those that
+    were handed out most recently and may still be in use.
+    """
+
+    def __init__(self, capture):
+        self.capture = capture
+        self.frame = None
+        self.timestamp = None  # monotonic time at which the latest frame was captured
+        self.index = self.consumed = 0  # number of frames captured, and the last one handed out
+        self.dropped = 0
+        self.running = True
+        # Enough buffers for the frames still held by the consumer, the latest frame and the one being captured
+        self.buffers = FramePool(HELD_FRAMES + 2)
+        self.handed = deque(maxlen=HELD_FRAMES)  # the frames handed out most recently
+
+        self.condition = threading.Condition()
+        self.signal = FrameSignal()
+        self.thread = threading.Thread(target=self._run, name="frame-grabber", daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        """ Reads frames from the capture device until released. """
+        while self.running:
+            with self.condition:
+                buffer = self.buffers.take(busy=(self.frame, *self.handed))
+            ok, frame = self.capture.read(buffer)
+            if not ok:
+                time.sleep(0.01)  # give a disconnected or warming-up camera a moment
+                continue
+
+            with self.condition:
+                # The previous frame was never consumed, so it is being dropped
+                if self.index > self.consumed and self.frame is not None:
+                    self.dropped += 1
+                    metrics.count("oncrop_frames_dropped_total")
+
+                self.buffers.put(frame)
+                self.frame = frame
+                self.timestamp = time.monotonic()
+                self.index += 1
+                self.condition.notify_all()
+            self.signal.notify()
+
+        self.capture.release()
+
+    def read(self, timeout=1.0):
+        """ Waits for a frame newer than the last one returned, and returns it in the same form as
+        `cv2.VideoCapture.read`. """
+        return self.read_timed(timeout)[:2]
+
+    def read_timed(self, timeout=1.0):
+        """ Like `read`, but returns the (ok, frame, timestamp) of the frame, where the timestamp is the
+        monotonic time at which that frame, rather than whichever is now the latest, was captured. """
+        with self.condition:
+            self.condition.wait_for(lambda: self.index > self.consumed or not self.running, timeout)
+            if not self.running:
+                return False, None, None
+            self.consumed = self.index
+            self.handed.append(self.frame)
+            return self.frame is not None, self.frame, self.timestamp
+
+    def release(self):
+        """ Stops the capture thread, which then releases the capture device. """
+        self.running = False
+        with self.condition:
+            self.condition.notify_all()
+        self.signal.notify()
+
+
+class MarkerDetector:
+    """
+    Locates ARUCO markers within frames. Kept separate from the processing engine so that a single
+    detector can serve many engines that share the same camera.
+
+    In tracking mode, the detector first searches a padded window around the markers found in the
+    previous frame. It falls back to searching the whole frame after `max_misses` consecutive misses,
+    after a marker found by the last full search goes missing from the window, and at least every
+    `refresh` frames regardless, so that markers entering the frame are found. Detection can also run
+    on a copy downscaled by `scale`, with the corners refined at full resolution afterwards. The
+    `frames`, `found` and `full_searches` counters make the detection rate comparable against plain
+    full-frame detection.
+    """
+
+    def __init__(self, track=False, scale=1.0, padding=TRACK_PADDING, max_misses=TRACK_MISSES,
+                 refresh=TRACK_REFRESH):
+        self.aruco_dict = aruco.Dictionary_get(aruco.DICT_6X6_250)
+        # Create detection parameters
+        self.parameters = aruco.DetectorParameters_create()
+
+        self.track = track
+        self.scale = scale
+        self.padding = padding
+        self.max_misses = max_misses
+        self.refresh = refresh
+        self.window = None  # (x1, y1, x2, y2) bounds of the markers in the last frame
+        self.misses = 0
+        self.tracked = 0  # frames searched only within the window since the last full search
+        self.known = frozenset()  # the IDs of the markers found by the last full search
+        self.frames = self.found = self.full_searches = 0
+        self.buffers = {}  # reusable flat buffers for the grayscale, and downscaled, search window
+
+    def reset(self):
+        """ Forgets where the markers were, so that the next frame is searched in full. """
+        self.window = None
+        self.misses = self.tracked = 0
+        self.known = frozenset()
+
+    def detect(self, frame):
+        """ Returns the corners and ids of every marker found in the given BGR frame. """
+        self.frames += 1
+        frame_y, frame_x = frame.shape[:2]
+        x1, y1, x2, y2 = 0, 0, frame_x, frame_y
+
+        # Restrict the search to the neighbourhood of the last known markers, if possible
+        windowed = (self.track and self.window is not None and self.misses < self.max_misses
+                    and self.tracked < self.refresh)
+        if windowed:
+            self.tracked += 1
+            wx1, wy1, wx2, wy2 = self.window
+            pad = int(self.padding * max(wx2 - wx1, wy2 - wy1))
+            x1, y1 = max(0, wx1 - pad), max(0, wy1 - pad)
+            x2, y2 = min(frame_x, wx2 + pad), min(frame_y, wy2 + pad)
+        else:
+            self.tracked = 0
+            self.full_searches += 1
+
+        start = time.perf_counter()
+        gray = cv2.cvtColor(frame[y1:y2, x1:x2], cv2.COLOR_BGR2GRAY, dst=self._image("gray", y2 - y1, x2 - x1))
+        metrics.observe("convert", start)
+
+        start = time.perf_counter()
+        corners, ids = self._find(gray)
+        metrics.observe("detect", start)
+        metrics.count("oncrop_detections_total")
+
+        if not len(corners):
+            self.misses += 1
+            if not windowed:
+                self.known = frozenset()
+            return (), None
+
+        # A marker that was in the frame is missing from the window, so search the whole of the next frame
+        found = frozenset(int(i) for i in ids.ravel())
+        if not windowed:
+            self.known = found
+        elif not self.known <= found:
+            self.tracked = self.refresh
+
+        # Shift the corners from window coordinates back into frame coordinates
+        for corner in corners:
+            corner += (x1, y1)
+
+        self.found += 1
+        metrics.count("oncrop_detection_hits_total")
+        self.misses = 0
+        points = np.concatenate(corners).reshape(-1, 2)
+        self.window = tuple(int(v) for v in (*points.min(axis=0), *points.max(axis=0)))
+        return corners, ids
+
+    def _find(self, gray):
+        """ Detects markers in a grayscale image, downscaling it first if configured to. """
+        if self.scale >= 1.0:
+            corners, ids, _ = aruco.detectMarkers(gray, self.aruco_dict, parameters=self.parameters)
+            return corners, ids
+
+        small = self._image("small", int(round(gray.shape[0] * self.scale)), int(round(gray.shape[1] * self.scale)))
+        small = cv2.resize(gray, small.shape[::-1], dst=small, interpolation=cv2.INTER_AREA)
+        corners, ids, _ = aruco.detectMarkers(small, self.aruco_dict, parameters=self.parameters)
+
+        # Scale the corners back up and refine them against the full resolution image
+        size = int(round(1 / self.scale)) + 1
+        for corner in corners:
+            corner /= self.scale
+            cv2.cornerSubPix(gray, corner.reshape(-1, 1, 2), (size, size), (-1, -1), SUBPIX_CRITERIA)
+
+        return corners, ids
+
+    def _image(self, name, height, width):
+        """ Returns a contiguous (height, width) image carved from the front of the named reusable buffer,
+        which is only reallocated when it is too small, since the search window changes size every frame. """
+        buffer = self.buffers.get(name)
+        if buffer is None or buffer.size < height * width:
+            buffer = self.buffers[name] = np.empty(height * width, np.uint8)
+        return buffer[:height * width].reshape(height, width)
+
+
+class RingSmoother:
+    """
+    Averages the last few measurements of a value, kept in a fixed-size ring buffer, to steady a
+    jittery detection without shifting a list on every frame.
+    """
+
+    def __init__(self, shape, size=BLOB_SMOOTHING):
+        self.values = np.zeros((size, *shape), np.float32)
+        self.count = 0
+
+    def clear(self):
+        """ Forgets every measurement, such as when the value was lost. """
+        self.count = 0
+
+    def add(self, value):
+        """ Records a measurement, overwriting the oldest one if the buffer is full, and returns the
+        average of the measurements in the buffer. """
+        self.values[self.count % len(self.values)] = value
+        self.count += 1
+        return self.values[:min(self.count, len(self.values))].mean(axis=0)
+
+
+class BlobDetector:
+    """
+    An alternative to ARUCO detection that tracks pairs of colored dots, one pair per color, with the
+    color's index in `BLOB_COLORS` as the marker ID. Every pixel of a downscaled copy of the frame is
+    classified in a single pass through a precomputed lookup table of quantized BGR values, and the
+    dots of every color are then found in a single connected components pass. Each pair is reported
+    as a square marker centered between its dots and oriented along them, so it can stand in for a
+    `MarkerDetector` anywhere.
+    """
+
+    def __init__(self, colors=BLOB_COLORS, scale=BLOB_SCALE, min_area=BLOB_MIN_AREA, smoothing=BLOB_SMOOTHING):
+        self.scale = scale
+        self.min_area = min_area * scale ** 2  # in the pixels of the downscaled frame
+        self.smoothers = [RingSmoother((4, 2), smoothing) for _ in colors]
+        self.frames = self.found = self.full_searches = 0
+        self.buffers = {}  # reusable buffers for the downscaled frame, its lookup indices and its components
+
+        # Label every quantized BGR value with the 1-based index of the color whose range contains it
+        shift = 8 - BLOB_BITS
+        centers = (np.arange(2 ** BLOB_BITS) << shift) + (1 << shift >> 1)
+        b, g, r = np.meshgrid(centers, centers, centers, indexing="ij")
+        self.lut = np.zeros(2 ** (3 * BLOB_BITS), np.uint8)
+        for label, (lower, upper) in enumerate(colors, 1):
+            inside = ((b >= lower[0]) & (b <= upper[0]) & (g >= lower[1]) & (g <= upper[1]) &
+                      (r >= lower[2]) & (r <= upper[2]))
+            self.lut[inside.ravel()] = label
+
+        # Tables that shift each quantized channel into its place in the lookup index
+        values = np.arange(256, dtype=np.uint16) >> shift
+        self.channel_lut = np.dstack((values << 2 * BLOB_BITS, values << BLOB_BITS, values)).reshape(256, 1, 3)
+
+    def reset(self):
+        """ Forgets the smoothed corners of every pair of dots, such as when the camera is reopened. """
+        for smoother in self.smoothers:
+            smoother.clear()
+
+    def detect(self, frame):
+        """ Returns the corners and ids of every pair of dots found in the given BGR frame. """
+        self.frames += 1
+        self.full_searches += 1
+        frame_y, frame_x = frame.shape[:2]
+        small_x, small_y = int(round(frame_x * self.scale)), int(round(frame_y * self.scale))
+
+        # Downscaling by area also blurs away the noise the dots are found through
+        start = time.perf_counter()
+        small = self._buffer("small", (small_y, small_x, 3), np.uint8)
+        cv2.resize(frame, (small_x, small_y), dst=small, interpolation=cv2.INTER_AREA)
+        shifted = self._buffer("shifted", (small_y, small_x, 3), np.uint16)
+        cv2.LUT(small, self.channel_lut, dst=shifted)
+        index = self._buffer("index", (small_y, small_x), np.uint16)
+        cv2.transform(shifted, CHANNEL_SUM, dst=index)
+        labels = self.lut[index]  # indexing directly avoids widening every index, unlike `np.take`
+        cv2.morphologyEx(labels, cv2.MORPH_OPEN, None, dst=labels)  # drop single stray pixels
+        metrics.observe("convert", start)
+
+        start = time.perf_counter()
+        components = self._buffer("components", (small_y, small_x), np.int32)
+        count, _, stats, centroids = cv2.connectedComponentsWithStats(labels, components, connectivity=8)
+        dots = [[] for _ in self.smoothers]  # (area, center) of the dots of each color
+        for component in range(1, count):
+            x, y, w, h, area = stats[component]
+            # Dots are round, so they fill a good part of their bounding box
+            if area < self.min_area or area < BLOB_FILL * w * h:
+                continue
+            cx, cy = centroids[component]
+            label = labels[min(int(cy), small_y - 1), min(int(cx), small_x - 1)]
+            if label:
+                # Pixels of the downscaled frame cover several of the full frame, centered between them
+                dots[label - 1].append((area, (centroids[component] + 0.5) / self.scale - 0.5))
+        metrics.observe("detect", start)
+        metrics.count("oncrop_detections_total")
+
+        corners, ids = [], []
+        for color, (found, smoother) in enumerate(zip(dots, self.smoothers)):
+            if len(found) < 2:
+                smoother.clear()
+                continue
+            # The two largest dots of a color are its pair, ordered from top to bottom
+            (_, top), (_, bottom) = sorted(sorted(found, key=lambda dot: -dot[0])[:2], key=lambda dot: dot[1][1])
+            corners.append(smoother.add(self.square(top, bottom)).reshape(1, 4, 2))
+            ids.append(color)
+
+        if not corners:
+            return (), None
+        self.found += 1
+        metrics.count("oncrop_detection_hits_total")
+        return tuple(corners), np.int32(ids).reshape(-1, 1)
+
+    @staticmethod
+    def square(top, bottom):
+        """ Returns the corners of the square marker a pair of dots stands for, centered between them,
+        `BLOB_SPAN` times smaller than the distance between them, and turned along with them. """
+        down = (bottom - top) / BLOB_SPAN
+        right = np.float32([down[1], -down[0]])
+        center = (top + bottom) / 2
+        return np.float32([center - right / 2 - down / 2, center + right / 2 - down / 2,
+                           center + right / 2 + down / 2, center - right / 2 + down / 2])
+
+    def _buffer(self, name, shape, dtype):
+        """ Returns the named reusable buffer, reallocating it only when the frame size changes. """
+        buffer = self.buffers.get(name)
+        if buffer is None or buffer.shape != shape:
+            buffer = self.buffers[name] = np.empty(shape, dtype)
+        return buffer
+
+
+def create_detector(tracker="aruco", track=False):
+    """ Creates the marker detector of the named tracking backend, either `aruco` markers or `blob` pairs
+    of colored dots. Only ARUCO detection can search around the markers of the last frame. """
+    if tracker == "aruco":
+        return MarkerDetector(track=track)
+    if tracker == "blob":
+        return BlobDetector()
+    raise ValueError("Unknown tracker! Must be `aruco` or `blob`.")
+
+
+class CameraBroadcaster:
+    """
+    A process-wide camera service. A single capture thread and a single marker detector run once per
+    frame, and the results are fanned out to every subscribed engine, which only has to composite its
+    own face and encode the result. Subscribers are reference counted: the camera is opened by the
+    first subscriber and released when the last one leaves.
+    """
+
+    _instance = None
+    _instance_lock = threading.Lock()
 
-    def read(self):
-        """ Returns the stored byte sequence. """
-        return None, self.bytes
+    def __init__(self, device=0, tracker="aruco"):
+        self.device = device  # a camera index, or a function that opens a stand-in capture device
+        self.detector = create_detector(tracker, track=True)
+        self.subscribers = 0
+        self.grabber = self.thread = None
+        self.running = False
+
+        self.lock = threading.Lock()  # guards the subscriber count
+        self.condition = threading.Condition()  # guards the published frame
+        self.signal = FrameSignal()  # tells the subscribers waiting on an event loop of every published frame
+        self.frame = self.corners = self.ids = None
+        self.index = 0
+        self.encodings = {}  # futures of the encodings of unmodified frames, shared between subscribers
+
+    @classmethod
+    def instance(cls):
+        """ Returns the broadcaster shared by the whole process, creating it if necessary. """
+        with cls._instance_lock:
+            if cls._instance is None:
+                cls._instance = cls()
+            return cls._instance
+
+    def subscribe(self):
+        """ Registers a new viewer, opening the camera if it is the first one. """
+        with self.lock:
+            self.subscribers += 1
+            if self.subscribers == 1:
+                # Wait for the previous capture thread to stop, then forget where its markers were
+                if self.thread is not None:
+                    self.thread.join()
+                self.detector.reset()
+
+                self.running = True
+                capture = self.device() if callable(self.device) else cv2.VideoCapture(self.device)
+                self.grabber = FrameGrabber(capture)
+                self.thread = threading.Thread(target=self._run, args=(self.grabber,),
+                                               name="camera-broadcaster", daemon=True)
+                self.thread.start()
+
+        return Subscription(self)
+
+    def unsubscribe(self):
+        """ Removes a viewer, releasing the camera if it was the last one. """
+        with self.lock:
+            self.subscribers -= 1
+            if self.subscribers == 0:
+                self.running = False
+                self.grabber.release()
+                # Forget the last frame, so the next viewer never receives one from a previous session
+                with self.condition:
+                    self.frame = self.corners = self.ids = None
+                    self.index = 0
+                    self.encodings.clear()
+                    self.condition.notify_all()
+                self.signal.notify()
+
+    def _run(self, grabber):
+        """ Detects markers in every new frame and publishes the results to the subscribers. """
+        while grabber.running:
+            ok, frame = grabber.read()
+            if not ok:
+                continue
+
+            corners, ids = self.detector.detect(frame)
+            with self.condition:
+                if not grabber.running:
+                    break  # the camera was released, and its frame forgotten, while detecting
+                self.frame, self.corners, self.ids = frame, corners, ids
+                self.index += 1
+                self.condition.notify_all()
+            self.signal.notify()
+
+    def encode(self, index, frame, encoder):
+        """ Returns a future of the JPEG encoding of the frame with the given index, with the encoder's
+        parameters, submitting it only if no other subscriber has done so already. """
+        key = (index, tuple(encoder.params))
+        with self.condition:
+            if key not in self.encodings:
+                # Only the encodings of the newest frame are worth sharing
+                if any(k[0] != index for k in self.encodings):
+                    self.encodings.clear()
+                self.encodings[key] = encoder.submit(frame, detect_changes=False)
+            return self.encodings[key]
+
+    def read(self, last_index, timeout=1.0):
+        """ Waits for a frame newer than `last_index`, returning its index, the frame and its detected
+        markers. The frame is shared between subscribers and must not be modified. """
+        with self.condition:
+            self.condition.wait_for(lambda: self.index > last_index or not self.running, timeout)
+            return self.index, self.frame, self.corners, self.ids
+
+
+class Subscription:
+    """
+    A single viewer's handle onto a `CameraBroadcaster`. Reading returns a private copy of the
+    newest frame, which the viewer is free to draw on, along with the markers already found in it.
+    The copies are made into a pool of reusable buffers.
+    """
+
+    def __init__(self, broadcaster):
+        self.broadcaster = broadcaster
+        self.signal = broadcaster.signal
+        self.index = 0
+        self.released = False
+        self.buffers = FramePool()
+
+    def read(self, timeout=1.0):
+        """ Waits for a frame newer than the last one returned, and returns whether one was read, the frame,
+        and its detected marker corners and ids. """
+        self.index, frame, corners, ids = self.broadcaster.read(self.index, timeout)
+        if frame is None:
+            return False, None, (), None
+        return True, self.buffers.copy(frame), corners, ids
+
+    def release(self):
+        """ Unsubscribes from the broadcaster, exactly once. """
+        if not self.released:
+            self.released = True
+            self.broadcaster.unsubscribe()
+
+
+class OverlayCache:
+    """
+    A bounded LRU cache of face overlays, keyed on the quantized width of the tracked marker. Each
+    entry holds the resized and flipped BGR face, premultiplied by its alpha, along with the
+    inverse alpha broadcast to three channels, so that a steady camera does not resize the face
+    and rebuild its masks on every frame. Faces without an alpha channel are treated as opaque, and
+    faces given as a pyramid are resized from its smallest level that is still wide enough.
+    """
+
+    def __init__(self, max_size=CACHE_SIZE, step=WIDTH_STEP):
+        self.max_size = max_size
+        self.step = step
+        self.entries = OrderedDict()
+        self.hits = self.misses = 0
+
+    def clear(self):
+        """ Drops all of the cached overlays. """
+        self.entries.clear()
+
+    def get(self, face, w):
+        """ Returns the (face, alpha_inv) overlay for the given marker width, building and
+        caching it if necessary. The face is either an image or a pyramid of one. """
+        # Quantize the width so that small jitters in the detected marker reuse the same overlay
+        key = max(self.step, int(round(w / self.step)) * self.step)
+
+        if key in self.entries:
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return self.entries[key]
+
+        self.misses += 1
+        start = time.perf_counter()
+        levels = face if isinstance(face, tuple) else (face,)
+        width = FACE_SCL * key
+        ratio = levels[0].shape[0] / levels[0].shape[1]
+        level = next((level for level in reversed(levels) if level.shape[1] >= width), levels[0])
+        resized = cv2.resize(level, (width, int(width * ratio)))
+        resized = cv2.flip(resized, 1)  # so the face displays properly in the web browser
+
+        if resized.shape[2] == 4:  # image is a png
+            alpha = cv2.cvtColor(resized[:, :, 3], cv2.COLOR_GRAY2BGR)
+            resized = cv2.multiply(np.ascontiguousarray(resized[:, :, :3]), alpha, scale=1 / 255)
+            alpha_inv = cv2.bitwise_not(alpha)
+        else:  # image is a jpg or similar, and is fully opaque
+            alpha_inv = np.zeros_like(resized)
+
+        entry = (resized, alpha_inv)
+        metrics.observe("resize", start)
+        self.entries[key] = entry
+
+        # Evict the least recently used overlay if the cache is full
+        if len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+        return entry
+
+
+class FaceWarper:
+    """
+    Warps face overlays onto an arbitrary quadrilateral, to place the face in perspective on the plane
+    of a tilted marker. Only the bounding box of the quadrilateral is warped, and the result is reused
+    outright for as long as the quadrilateral's corners move less than `threshold` pixels.
+
+    The premultiplied face and its inverse alpha are packed into a single four-channel image, which
+    is warped in one pass (about twice as fast as warping each separately) into reusable buffers, then
+    split back apart for blending.
+    """
+
+    def __init__(self, threshold=WARP_THRESHOLD):
+        self.threshold = threshold
+        self.last = None  # (overlay, quad, bounds) of the last warp
+        self.packed = None  # (overlay, packed image) of the last overlay warped
+        self.buffers = None  # (packed, face, alpha_inv) buffers the last warp was written into
+        self.warps = self.reused = 0
+
+    def clear(self):
+        """ Forgets the last warp. """
+        self.last = self.packed = None
+
+    def warp(self, overlay, quad, bounds):
+        """ Warps an overlay from `OverlayCache` so that its corners land on the given quadrilateral,
+        within the given (x1, y1, x2, y2) bounds of the frame. Returns the bounds, and the warped
+        premultiplied face and inverse alpha to composite within them. """
+        if self.last is not None and self.last[0] is overlay and np.abs(quad - self.last[1]).max() < self.threshold:
+            self.reused += 1
+            return (self.last[2], *self.buffers[1:])
+
+        self.warps += 1
+        start = time.perf_counter()
+        if self.packed is None or self.packed[0] is not overlay:
+            face, alpha_inv = overlay
+            self.packed = (overlay, cv2.merge((*cv2.split(face), alpha_inv[:, :, 0])))
+        packed = self.packed[1]
+
+        x1, y1, x2, y2 = bounds
+        height, width = packed.shape[:2]
+        source = np.float32([[0, 0], [width, 0], [width, height], [0, height]])
+        homography = cv2.getPerspectiveTransform(source, np.float32(quad - (x1, y1)))
+
+        # Everything outside the face is left fully transparent
+        if self.buffers is None or self.buffers[0].shape[:2] != (y2 - y1, x2 - x1):
+            self.buffers = tuple(np.empty((y2 - y1, x2 - x1, n), np.uint8) for n in (4, 3, 3))
+        warped, face, alpha_inv = self.buffers
+        cv2.warpPerspective(packed, homography, (x2 - x1, y2 - y1), dst=warped,
+                            borderMode=cv2.BORDER_CONSTANT, borderValue=(0, 0, 0, 255))
+        cv2.mixChannels([warped], [face, alpha_inv], [0, 0, 1, 1, 2, 2, 3, 3, 3, 4, 3, 5])
+        metrics.observe("warp", start)
+
+        self.last = (overlay, quad, bounds)
+        return bounds, face, alpha_inv
+
+
+class FrameEncoder:
+    """
+    Encodes processed frames as JPEGs on a small shared thread pool, which runs alongside the
+    processing of the next frame since OpenCV releases the GIL while encoding. When asked to, a small
+    thumbnail of the frame is compared against that of the last one encoded, and a frame in which no
+    part has visibly changed reuses the previous encoding instead of being encoded again. Engines only
+    ask for frames without a face composited onto them, since a face may move while the camera is still.
+    """
+
+    pool = ThreadPoolExecutor(ENCODER_THREADS, thread_name_prefix="frame-encoder")
+
+    def __init__(self, quality=JPEG_QUALITY, subsampling=None, threshold=CHANGE_THRESHOLD):
+        self.params = [cv2.IMWRITE_JPEG_QUALITY, quality]
+        if subsampling is not None:
+            if subsampling not in JPEG_SUBSAMPLING:
+                raise ValueError("Chroma subsampling must be one of {}.".format(", ".join(JPEG_SUBSAMPLING)))
+            # Chroma subsampling is only configurable on OpenCV 4.5.5 and later
+            factor = getattr(cv2, "IMWRITE_JPEG_SAMPLING_FACTOR_{}".format(subsampling), None)
+            if factor is None:
+                warnings.warn("This build of OpenCV cannot set the chroma subsampling of JPEGs, so `{}` is "
+                              "ignored.".format(subsampling), RuntimeWarning)
+            else:
+                self.params += [cv2.IMWRITE_JPEG_SAMPLING_FACTOR, factor]
+
+        self.threshold = threshold
+        self.thumbnail = None
+        self.last = None  # future of the last submitted encoding
+        self.encoded = self.reused = 0
+
+    def submit(self, frame, detect_changes=True):
+        """ Returns a future of the given frame's JPEG byte sequence, encoding it on the pool unless
+        `detect_changes` is set and no part of it has visibly changed since the last frame submitted. """
+        if detect_changes:
+            thumbnail = cv2.resize(frame, THUMBNAIL_SIZE, interpolation=cv2.INTER_AREA)
+            if self.last is not None and cv2.norm(thumbnail, self.thumbnail, cv2.NORM_INF) < self.threshold:
+                self.reused += 1
+                return self.last
+
+        self.encoded += 1
+        future = self.pool.submit(self.encode, frame)
+        # Only frames that were compared can be reused, since any other may differ from the next one
+        self.thumbnail, self.last = (thumbnail, future) if detect_changes else (None, None)
+        return future
+
+    def encode(self, frame):
+        """ Encodes the given frame as a JPEG, on the calling thread. The encoding is returned as the
+        buffer OpenCV wrote it into, rather than copied into a byte sequence. """
+        start = time.perf_counter()
+        encoded = cv2.imencode('.jpg', frame, self.params)[1]
+        metrics.observe("encode", start)
+        return encoded
+
+
+class FaceStore:
+    """
+    Holds uploaded faces, decoded and preprocessed exactly once, keyed by the hash of their contents so
+    that identical uploads share a single entry. Uploads are cropped to the face in them, trimmed of
+    transparent borders, and shrunk to the largest size they can ever be drawn at. Decoded faces live
+    in a bounded in-process LRU as pyramids, backed by losslessly compressed copies in Redis (if given)
+    that survive eviction and are shared between processes.
+    """
+
+    _detector = None  # the Haar cascade that finds faces in uploads, loaded on first use
+    _detector_lock = threading.Lock()
+
+    def __init__(self, redis=None, max_size=FACE_STORE_SIZE, ttl=FACE_TTL):
+        self.redis = redis
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = self.misses = 0
+
+    def put(self, byte_seq):
+        """ Decodes an uploaded image and stores it, returning its key. Raises a ValueError if the
+        image cannot be decoded. """
+        key = hashlib.sha1(byte_seq).hexdigest()
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                return key
+
+        face = cv2.imdecode(np.frombuffer(byte_seq, np.uint8), cv2.IMREAD_UNCHANGED)
+        if face is None:
+            raise ValueError("The uploaded file is not a supported image.")
+        face = self.prepare(face)
+
+        if self.redis is not None:
+            compressed = cv2.imencode('.png', face, [cv2.IMWRITE_PNG_COMPRESSION, 1])[1].tobytes()
+            self.redis.set("face:" + key, compressed, ex=self.ttl)
+
+        self._remember(key, face_pyramid(face))
+        return key
+
+    def get(self, key):
+        """ Returns the pyramid of the decoded face with the given key, or None if it is unknown or has
+        expired. """
+        with self.lock:
+            if key in self.entries:
+                self.hits += 1
+                self.entries.move_to_end(key)
+                return self.entries[key]
+
+        self.misses += 1
+        compressed = self.redis.get("face:" + key) if self.redis is not None else None
+        if compressed is None:
+            return None
+
+        levels = face_pyramid(cv2.imdecode(np.frombuffer(compressed, np.uint8), cv2.IMREAD_UNCHANGED))
+        self._remember(key, levels)
+        return levels
+
+    def _remember(self, key, levels):
+        """ Inserts a face's pyramid into the LRU, evicting the least recently used one if it is full. """
+        for level in levels:
+            level.flags.writeable = False  # faces are shared between engines
+        with self.lock:
+            self.entries[key] = levels
+            self.entries.move_to_end(key)
+            if len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    @staticmethod
+    def normalize(face):
+        """ Converts a decoded image to 8-bit BGR, or BGRA if it has an alpha channel. """
+        if face.dtype != np.uint8:
+            face = cv2.convertScaleAbs(face, alpha=255 / np.iinfo(face.dtype).max)
+        if face.ndim == 2:
+            face = cv2.cvtColor(face, cv2.COLOR_GRAY2BGR)
+        elif face.shape[2] == 2:
+            face = cv2.merge((*[face[:, :, 0]] * 3, face[:, :, 1]))
+        return face
+
+    @classmethod
+    def prepare(cls, face, max_size=MAX_FRAME_SIZE):
+        """ Normalizes a decoded image, then trims it down to just the face: fully transparent borders
+        are cut away, opaque photos are cropped around the largest face found in them, and the result
+        is shrunk to fit within the (width, height) of `max_size`. """
+        face = cls.normalize(face)
+
+        if face.shape[2] == 4:
+            # Cut-outs already end at the person, so only their empty borders are trimmed
+            points = cv2.findNonZero(face[:, :, 3])
+            if points is not None:
+                x, y, w, h = cv2.boundingRect(points)
+                face = face[y:y + h, x:x + w]
+        else:
+            box = cls.find_face(face)
+            if box is not None:
+                # Keep some of the hair, chin and shoulders around the tightly detected face
+                x, y, w, h = box
+                pad_x, pad_y = int(FACE_MARGIN * w), int(FACE_MARGIN * h)
+                x1, y1 = max(0, x - pad_x), max(0, y - pad_y)
+                x2, y2 = min(face.shape[1], x + w + pad_x), min(face.shape[0], y + h + pad_y)
+                face = face[y1:y2, x1:x2]
+
+        # A face as wide or as tall as the frame is too close to be drawn, so any more detail is wasted
+        scale = min(max_size[0] / face.shape[1], max_size[1] / face.shape[0])
+        if scale < 1.0:
+            size = (max(1, int(face.shape[1] * scale)), max(1, int(face.shape[0] * scale)))
+            face = cv2.resize(face, size, interpolation=cv2.INTER_AREA)
+        return np.ascontiguousarray(face)
+
+    @classmethod
+    def find_face(cls, image):
+        """ Returns the (x, y, w, h) bounds of the largest face in a BGR image, or None if there is none.
+        Faces are detected in a downscaled copy, since uploads are often full resolution photos. """
+        scale = min(1.0, FACE_DETECT_SIZE / max(image.shape[:2]))
+        gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+        if scale < 1.0:
+            gray = cv2.resize(gray, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+
+        # The classifier is loaded once, and is not safe to share between threads
+        with cls._detector_lock:
+            if cls._detector is None:
+                cls._detector = cv2.CascadeClassifier(cv2.data.haarcascades + "haarcascade_frontalface_default.xml")
+            # The friend's face fills a good part of their own photo, so tiny faces are not searched for
+            smallest = int(FACE_MIN_FRACTION * min(gray.shape))
+            faces = cls._detector.detectMultiScale(cv2.equalizeHist(gray), scaleFactor=1.1, minNeighbors=5,
+                                                   minSize=(smallest, smallest))
+
+        if not len(faces):
+            return None
+        x, y, w, h = max(faces, key=lambda box: box[2] * box[3])
+        return tuple(int(v / scale) for v in (x, y, w, h))
+
+
+class MotionFilter:
+    """
+    A constant-velocity alpha-beta filter over the center and width of a marker. It smooths noisy
+    detections, and predicts the marker's pose on frames where detection was skipped or failed. Its
+    confidence decays with every predicted frame, and the pose is considered lost once it drops below
+    `MIN_CONFIDENCE`.
+    """
+
+    def __init__(self, alpha=FILTER_ALPHA, beta=FILTER_BETA, decay=FILTER_DECAY):
+        self.alpha = alpha
+        self.beta = beta
+        self.decay = decay
+        self.state = np.zeros((2, 3))  # the (x, y, w) pose, and its velocity in pixels per frame
+        self.confidence = 0.0
+
+    def reset(self):
+        """ Forgets the tracked pose, such as when the next frame does not follow on from the last. """
+        self.state[:] = 0
+        self.confidence = 0.0
+
+    def update(self, measurement):
+        """ Corrects the filter with a measured (x, y, w) pose, and returns the filtered pose. """
+        if self.confidence < MIN_CONFIDENCE:
+            # The marker was lost, so start again from the measurement
+            self.state[0] = measurement
+            self.state[1] = 0
+        else:
+            self.state[0] += self.state[1]
+            residual = np.subtract(measurement, self.state[0])
+            self.state[0] += self.alpha * residual
+            self.state[1] += self.beta * residual
+
+        self.confidence = 1.0
+        return self.state[0]
+
+    def predict(self):
+        """ Advances the filter by a frame without a measurement, and returns the predicted pose, or
+        None if the marker has been lost. """
+        if self.confidence < MIN_CONFIDENCE:
+            return None
+
+        self.state[0] += self.state[1]
+        self.confidence *= self.decay
+        return self.state[0] if self.confidence >= MIN_CONFIDENCE else None
+
+
+class MarkerTrack:
+    """
+    Everything an engine keeps about a single marker ID: the face placed on it, the motion filter
+    following its pose, the corners it was last measured at, and the overlays resized and warped for it.
+    """
+
+    def __init__(self, face):
+        self.face = face if isinstance(face, tuple) else face_pyramid(face)
+        self.motion = MotionFilter()
+        self.overlays = OverlayCache()
+        self.warper = FaceWarper()
+        self.marker = None  # the corners of the last measured marker, which move along with the filtered pose
+
+    def follow(self, corners=None):
+        """ Advances the track by a frame, returning the filtered (x, y, w) pose of the marker with the
+        given corners, or the predicted pose if it was not measured. Returns None once it is lost. """
+        if corners is None:
+            return self.motion.predict()
+
+        # Find the x, y, w, and h of the aruco code. Since the rotation and skew are not important,
+        # we approximate the measurments
+        x_plus = y_plus = 0  # for calculating the center of the aruco code
+        x_h_list = []  # for calculating the width of the aruco code
+
+        for corner in corners:
+            x_h_list.append(int(corner[0]))
+            x_plus += corner[0]
+            y_plus += corner[1]
+
+        x = int(x_plus / 4)  # x coordinate of aruco code center
+        y = int(y_plus / 4)  # y coordinate of aruco code center
+        min_x = min(x_h_list)
+        max_x = max(x_h_list)
+        w = max_x - min_x  # width of the aruco code
+        self.marker = corners.copy()
+        return self.motion.update((x, y, w))
+
+    def face_quad(self, pose):
+        """ Returns the corners of the face as it would appear on the plane of the last measured marker,
+        moved and scaled to the given filtered (x, y, w) pose. """
+        # Follow the filtered pose with the shape of the last measured marker
+        x, y, w = pose
+        span = np.ptp(self.marker[:, 0])
+        marker = (self.marker - self.marker.mean(axis=0)) * (w / span if span else 1.0) + (x, y)
+
+        # Center the face on the marker, FACE_SCL times as wide, in the marker's own coordinates
+        homography = cv2.getPerspectiveTransform(UNIT_SQUARE, np.float32(marker))
+        half_x = FACE_SCL / 2
+        half_y = half_x * self.face[0].shape[0] / self.face[0].shape[1]
+        rect = np.float32([[0.5 - half_x, 0.5 - half_y], [0.5 + half_x, 0.5 - half_y],
+                           [0.5 + half_x, 0.5 + half_y], [0.5 - half_x, 0.5 + half_y]])
+        return cv2.perspectiveTransform(rect.reshape(-1, 1, 2), homography).reshape(-1, 2)
 
 
 class ProcessingEngine:
@@ -32,78 +1239,207 @@ class ProcessingEngine:
     ARCUO markers in a media feed.
     """
 
-    def __init__(self, source, debug=False):
-        self.aruco_dict = aruco.Dictionary_get(aruco.DICT_6X6_250)
+    def __init__(self, source, debug=False, detect_every=DETECT_EVERY, quality=JPEG_QUALITY, subsampling=None,
+                 perspective=False, tracker="aruco", **options):
         self.debug = debug
         self.file_type = False
+        self.faces = {}  # marker ID -> face placed on it, where the face under None goes on every other marker
+        self.tracks = {}  # marker ID -> the track of every marker being followed
+        self.composited = False  # whether a face was drawn onto the last rendered frame
+        self.last_frame = None
+        self.perspective = perspective  # whether the face is warped onto the plane of the marker
+        self.encoder = FrameEncoder(quality, subsampling)
+        self.detector = create_detector(tracker)  # finds either ARUCO markers or pairs of colored dots
+        self.shared = source == "shared"
+        self.detect_every = detect_every  # run full detection every n frames, predicting in between
+        self.frames = 0
 
-        # Create detection parameters
-        self.parameters = aruco.DetectorParameters_create()
-
-        # Set up OpenCV. If the source is local, open a local camera feed. If it is a remote
-        # source, create an empty byte feed.
-        if source == "local":
-            self.cap = cv2.VideoCapture(0)
+        # Set up OpenCV. If the source is local, open a local camera feed. If it is shared, subscribe
+        # to the process-wide camera, which also detects the markers. If it is a remote source,
+        # create a byte feed that frames from the client are written into. Without a source, frames
+        # are handed straight to `process` instead.
+        if source is None:
+            self.cap = None
+        elif source == "local":
+            self.cap = FrameGrabber(cv2.VideoCapture(0))
+        elif source == "shared":
+            self.cap = CameraBroadcaster.instance().subscribe()
         elif source == "remote":
-            self.cap = ByteCapture()  # for future capabilities
+            self.cap = ByteCapture()
+        # Replay a recorded video, or generate frames, with any remaining options passed on to the capture
+        elif source == "file":
+            self.cap = FileCapture(**options)
+        elif source == "synthetic":
+            self.cap = SyntheticCapture(**options)
         # Throw an error if something isn't write
         else:
-            raise ("Unknown source type! Must be `local`, `file`, or `remote`.")
+            raise ValueError("Unknown source type! Must be `local`, `shared`, `file`, `synthetic`, `remote`, or None.")
 
-    @staticmethod
-    def generate_markers(num_markers):
-        """ Generate ARUCO markers if they do not exist, relative to the path of execution. """
-        # Create aruco markers if necessary
-        if not os.path.exists("./source/static/markers"):
-            os.system("mkdir ./source/static/markers")
+    def release(self):
+        """ Releases the underlying capture source, if it holds one. """
+        if hasattr(self.cap, "release"):
+            self.cap.release()
+
+    def set_face(self, face):
+        """ Sets the face to append to every marker, either a decoded image or the filename of one. """
+        self.set_faces({None: face})
+
+    def set_faces(self, faces):
+        """ Sets the faces to append, as a mapping from marker IDs to decoded images, pyramids of them, or
+        the filenames of them. The face under None, if any, is appended to every marker without a face of
+        its own. """
+        self.faces = {}
+        for marker_id, face in faces.items():
+            face = cv2.imread("{}".format(face), -1) if isinstance(face, str) else face
+            self.faces[marker_id] = face if isinstance(face, tuple) else face_pyramid(face)
+        # Any tracked markers have overlays built from the previous faces
+        self.tracks.clear()
+
+    def reset(self):
+        """ Forgets the poses of every tracked marker, such as when the next frame does not follow on
+        from the last. """
+        for track in self.tracks.values():
+            track.motion.reset()
 
-            # Create 10 unique markers
-            for marker_num in range(num_markers):
-                img = aruco.drawMarker(aruco.Dictionary_get(aruco.DICT_6X6_250), marker_num, 700)
-                cv2.imwrite("./source/static/markers/marker_{}.jpg".format(str(marker_num)), img)
+    def watch(self, callback):
+        """ Has the callback run, on the source's own thread, whenever the source has a new frame. Returns
+        False without doing so if the source does not signal its frames, since they never have to be
+        waited for. """
+        signal = getattr(self.cap, "signal", None)
+        if signal is None:
+            return False
+        signal.watch(callback)
+        return True
 
-    def set_face(self, filename):
-        """ Sets the face to append from a given filename. """
-        # print(filename)
-        self.face = cv2.imread("{}".format(filename), -1)
+    def unwatch(self, callback):
+        """ Stops running a callback given to `watch`. """
+        signal = getattr(self.cap, "signal", None)
+        if signal is not None:
+            signal.unwatch(callback)
 
+    def get_frame(self, timeout=None):
+        """ Reads and processes a frame, which is encoded as a JPEG and returned as a buffer of bytes (or
+        returned as-is in debug mode). Returns None if no frame could be read. `timeout` is passed on to
+        `render`. """
+        frame = self.render(timeout)
+        if frame is None or self.debug:
+            return frame
+        return self.encode(frame).result()
 
-    def get_frame(self):
+    def stream(self, idle_timeout=STREAM_IDLE_TIMEOUT):
+        """ Yields encoded frames until none has been read for `idle_timeout` seconds, such as when a remote
+        client stops sending them. Each frame is encoded on the encoder pool while the next one is read
+        and processed, at the cost of a frame of latency. While waiting, the last frame is yielded again
+        after every read timeout, so that a client which has disconnected is still noticed. """
+        pending = last = None
+        idle = time.monotonic()
+        while True:
+            frame = self.render()
+            current = self.encode(frame) if frame is not None else None
+            if pending is not None:
+                last = pending.result()
+                yield last
+            elif current is None and last is not None:
+                yield last
+            pending = current
+
+            if frame is not None:
+                idle = time.monotonic()
+            elif time.monotonic() - idle > idle_timeout:
+                return
+
+    def encode(self, frame):
+        """ Submits a processed frame for encoding, returning a future of its JPEG bytes. Frames
+        from a shared camera that have no face composited onto them are identical for every viewer,
+        so they are encoded once and shared. """
+        if self.shared and not self.composited:
+            return self.cap.broadcaster.encode(self.cap.index, frame, self.encoder)
+        return self.encoder.submit(frame, detect_changes=not self.composited)
+
+    def render(self, timeout=None):
         """ Reads a frame from the given capture device, identifies the markers and inserts the desired
-        faces. The processed frame is encoded as a JPEG and returned as a byte sequence. """
-        # ensure that the face is already set
-        assert self.face is not None, "There must be a face to superimpose."
+        faces. Returns the processed frame, or None if no frame could be read. If given, `timeout` is how
+        long a source that signals its frames waits for one, where 0 only takes a frame already waiting. """
+        # Shared cameras have already detected the markers in the frame
+        start = time.perf_counter()
+        wait = () if timeout is None or not hasattr(self.cap, "signal") else (timeout,)
+        if self.shared:
+            _, frame, corners, ids = self.cap.read(*wait)
+        else:
+            _, frame = self.cap.read(*wait)
+            corners = ids = None
+        metrics.observe("read", start)
+
+        # No frame arrived in time, such as when a remote client has not sent one yet
+        if frame is None:
+            return None
+        return self.process(frame, corners, ids)
+
+    def process(self, frame, corners=None, ids=None):
+        """ Inserts the desired faces into the given frame, which is drawn onto in place, at the markers
+        with the given corners and ids. If no corners are given, the markers are detected first. Returns
+        the processed frame. """
+        # ensure that the faces are already set
+        assert self.faces, "There must be a face to superimpose."
+        self.composited = False
+
+        # Only run detection every few frames, or whenever the motion filters are unsure of where the
+        # markers are. A single pass finds every marker in the frame.
+        self.frames += 1
+        metrics.count("oncrop_frames_total")
+        if corners is None:
+            corners = ()
+            if self.frames % self.detect_every == 0 or self.confidence < DETECT_CONFIDENCE:
+                corners, ids = self.detector.detect(frame)
+
+        # Start following every marker that has a face to place on it
+        measured = {}
+        for corner, marker_id in zip(corners, ids.ravel() if ids is not None else ()):
+            marker_id = int(marker_id)
+            if marker_id in self.faces or None in self.faces:
+                measured[marker_id] = corner[0]
+                if marker_id not in self.tracks:
+                    self.tracks[marker_id] = MarkerTrack(self.faces.get(marker_id, self.faces.get(None)))
 
-        _, frame = self.cap.read()
+        # Smooth the measured poses, or predict those of the markers not measured in this frame
+        placements = []
+        for marker_id, track in list(self.tracks.items()):
+            pose = track.follow(measured.get(marker_id))
+            if pose is not None:
+                placements.append((pose[2], track, pose))
+            elif marker_id not in self.faces:
+                del self.tracks[marker_id]  # only the tracks of faces set for a specific marker are kept
+
+        # Place the faces of the smallest, and so farthest, markers first, so nearer ones cover them
+        for _, track, pose in sorted(placements, key=lambda placement: placement[0]):
+            self.place(frame, track, pose)
+
+        self.last_frame = frame
+        return frame
+
+    @property
+    def confidence(self):
+        """ The lowest confidence in the pose of any marker that is still being followed, or 0 if none are. """
+        confidences = [t.motion.confidence for t in self.tracks.values() if t.motion.confidence >= MIN_CONFIDENCE]
+        return min(confidences, default=0.0)
+
+    def place(self, frame, track, pose):
+        """ Blends the face of a track into the frame, in place, at the given filtered (x, y, w) pose. """
         frame_x = frame.shape[1]
         frame_y = frame.shape[0]
+        x, y, w = (int(v) for v in pose)
 
-        gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-        corners, _, _ = aruco.detectMarkers(gray, self.aruco_dict, parameters=self.parameters)
-
-        # there must be only one aruco code at this point
-        if len(corners) == 1:
-            # Find the x, y, w, and h of the aruco code. Since the rotation and skew are not important,
-            # we approximate the measurments
-            x_plus = y_plus = 0  # for calculating the center of the aruco code
-            x_h_list = []  # for calculating the width of the aruco code
-
-            for corner in corners[0][0]:
-                x_h_list.append(int(corner[0]))
-                x_plus += corner[0]
-                y_plus += corner[1]
-
-            x = int(x_plus / 4)  # x coordinate of aruco code center
-            y = int(y_plus / 4)  # y coordinate of aruco code center
-            min_x = min(x_h_list)
-            max_x = max(x_h_list)
-            w = max_x - min_x  # width of the aruco code
-
-            # change x and y to be offsets instead of the center
-            ratio = self.face.shape[0] / self.face.shape[1]
-            # print(self.face, ratio)
-            face = cv2.resize(self.face, (FACE_SCL * w, int(FACE_SCL * w * ratio)))
-            face = cv2.flip(face, 1)  # so the face displays properly in the web browser
+        # In perspective, the face covers the quadrilateral it would span on the plane of the marker,
+        # unless the marker is so tilted that the quadrilateral folds over on itself
+        quad = track.face_quad(pose) if self.perspective and track.marker is not None else None
+        if quad is not None and cv2.isContourConvex(quad):
+            x1, y1 = (int(v) for v in np.floor(quad.min(axis=0)))
+            x2, y2 = (int(v) for v in np.ceil(quad.max(axis=0)))
+        else:
+            quad = None
+
+            # Retrieve the resized and flipped face, and its inverse alpha, for the current marker width
+            face, alpha_inv = track.overlays.get(track.face, w)
 
             face_x = face.shape[1]
             face_y = face.shape[0]
@@ -131,50 +1467,74 @@ class ProcessingEngine:
                 y2 = frame_y
                 y1 = frame_y - face_y
 
-            # if the face is too big, stop displaying image and replace with error text
-            if x2 - x1 >= frame_x or y2 - y1 >= frame_y:
-                # To display the text correctly because the image is flipped when displayed:
-                frame = cv2.flip(frame, 1)  # flip the frame
-                x = abs(frame_x - x) - 150  # change the x value of the text to match flip
-
-                # handle clipping
-                if x < 0:
-                    x = 0
-                if x > frame_x:
-                    x = frame_x
-                if y < 0:
-                    y = 0
-                if y > frame_y:
-                    y = frame_y
-
-                cv2.putText(frame, "You are too close to the frame", (x, y), cv2.FONT_HERSHEY_SIMPLEX, 0.6,
-                            (255, 255, 255), 2)  # apply the text
-                frame = cv2.flip(frame, 1)  # flip the frame back; now the text will appear correctly in the browser
-                return frame if self.debug else cv2.imencode('.jpg', frame)[1].tobytes()
-            else:  # face is correct size
-                pass
-
-            # pull out the region of interest:
-            roi = frame[y1:y2, x1:x2]
-
-            if self.face.shape[2] == 4:  # image is a png
-                mask = face[:, :, 3]
-                mask_inv = cv2.bitwise_not(mask)
-                frame_bg = cv2.bitwise_and(roi, roi, mask=mask_inv)
-                face_fg = cv2.bitwise_and(face, face, mask=mask)
-                dst = cv2.add(frame_bg, face_fg[:, :, :3])
-                frame[y1:y2, x1:x2] = dst
-            elif self.face.shape[2] == 3:  # image is a jpg or similar
-                frame[y1:y2, x1:x2] = face
-            else:  # from an unknown file type
-                pass
-
-            # Encode the final frame as a JPEG and return its byte sequence, if not in debug mode
-            return frame if self.debug else cv2.imencode('.jpg', frame)[1].tobytes()
+        # if the face is too big, stop displaying image and replace with error text
+        if x2 - x1 >= frame_x or y2 - y1 >= frame_y:
+            # The frame is flipped when displayed, so the text is drawn mirrored in order to read correctly
+            x = abs(frame_x - x) - 150  # change the x value of the text to match flip
 
-        else:
-            # Encode the final frame as a JPEG and return its byte sequence, if not in debug mode
-            return frame if self.debug else cv2.imencode('.jpg', frame)[1].tobytes()
+            # handle clipping
+            if x < 0:
+                x = 0
+            if x > frame_x:
+                x = frame_x
+            if y < 0:
+                y = 0
+            if y > frame_y:
+                y = frame_y
+
+            self.draw_mirrored(frame, TOO_CLOSE, (x, y))  # apply the text
+            self.composited = True
+            return
+
+        # Warp the face onto its quadrilateral, within the part of its bounding box inside the frame
+        if quad is not None:
+            x1, y1, x2, y2 = max(0, x1), max(0, y1), min(frame_x, x2), min(frame_y, y2)
+            if x1 >= x2 or y1 >= y2:
+                return
+            # Resize the face to about the width it is drawn at, so the warp neither blurs nor aliases it
+            width = (np.linalg.norm(quad[1] - quad[0]) + np.linalg.norm(quad[2] - quad[3])) / 2
+            overlay = track.overlays.get(track.face, width / FACE_SCL)
+            (x1, y1, x2, y2), face, alpha_inv = track.warper.warp(overlay, quad, (x1, y1, x2, y2))
+
+        # Blend the face into the region of interest, in place
+        start = time.perf_counter()
+        composite(frame[y1:y2, x1:x2], face, alpha_inv)
+        metrics.observe("composite", start)
+        self.composited = True
+
+    @staticmethod
+    def draw_mirrored(frame, text, origin):
+        """ Draws white text onto the frame, in place, as it would appear if drawn at `origin` on the
+        horizontally flipped frame. Only the patch under the text is flipped, rather than the whole
+        frame, and flipped back once the text is drawn on it. """
+        font, scale, thickness = cv2.FONT_HERSHEY_SIMPLEX, 0.6, 2
+        (width, height), baseline = cv2.getTextSize(text, font, scale, thickness)
+        frame_y, frame_x = frame.shape[:2]
+        x, y = origin
+
+        # Bound the text in flipped coordinates, with a margin for its thickness, and clip it to the frame
+        x1, y1 = max(0, x - thickness), max(0, y - height - thickness)
+        x2, y2 = min(frame_x, x + width + thickness), min(frame_y, y + baseline + thickness)
+        if x1 >= x2 or y1 >= y2:
+            return
+
+        # Flip the patch under the text, draw the text on it, and flip it back into place
+        roi = frame[y1:y2, frame_x - x2:frame_x - x1]
+        patch = cv2.flip(roi, 1)
+        cv2.putText(patch, text, (x - x1, y - y1), font, scale, (255, 255, 255), thickness)
+        cv2.flip(patch, 1, dst=roi)
+
+    def snapshot(self, fmt="jpeg"):
+        """ Encodes the most recently rendered frame at full quality, as either a JPEG or a PNG. Returns
+        None if no frame has been rendered yet. """
+        frame = self.last_frame
+        if frame is None:
+            return None
+        # The frame's buffer is reused a few frames later, which may be sooner than it can be encoded
+        frame = frame.copy()
+        if fmt == "png":
+            return cv2.imencode('.png', frame)[1].tobytes()
+        return cv2.imencode('.jpg', frame, [cv2.IMWRITE_JPEG_QUALITY, 100])[1].tobytes()
 
 
 # Artifact of incremental testing
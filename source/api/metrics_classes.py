@@ -0,0 +1,94 @@
+"""
+Contains the classes used to profile the processing pipeline and export its metrics.
+
+@author: Elias Gabriel, Duncan Mazza
+@revision: v1.0
+"""
+import threading
+import time
+import numpy as np
+
+METRICS_WINDOW = 1024  # number of recent samples each stage's percentiles are computed over
+QUANTILES = (0.5, 0.95, 0.99)  # quantiles reported for every stage
+
+
+class RollingWindow:
+    """
+    A fixed-size ring buffer of the most recent samples of a measurement, along with the count and
+    sum of every sample ever recorded.
+    """
+
+    def __init__(self, size=METRICS_WINDOW):
+        self.values = np.zeros(size)
+        self.count = 0
+        self.total = 0.0
+
+    def add(self, value):
+        """ Records a sample, overwriting the oldest one if the window is full. """
+        self.values[self.count % len(self.values)] = value
+        self.count += 1
+        self.total += value
+
+    def quantiles(self, quantiles=QUANTILES):
+        """ Returns the given quantiles of the samples currently in the window. """
+        filled = self.values[:min(self.count, len(self.values))]
+        return np.quantile(filled, quantiles) if len(filled) else [float("nan")] * len(quantiles)
+
+
+class Metrics:
+    """
+    A process-wide registry of per-stage timings, counters and gauges, which can be rendered in the
+    Prometheus text format. Recording is cheap enough to leave on, and does nothing at all once
+    `enabled` is turned off.
+    """
+
+    def __init__(self, enabled=True, window=METRICS_WINDOW):
+        self.enabled = enabled
+        self.window = window
+        self.timings = {}
+        self.counters = {}
+        self.gauges = {}
+        self.lock = threading.Lock()
+
+    def observe(self, stage, start):
+        """ Records the time elapsed since `start`, a `time.perf_counter` reading, against a stage. """
+        if not self.enabled:
+            return
+        elapsed = time.perf_counter() - start
+        with self.lock:
+            if stage not in self.timings:
+                self.timings[stage] = RollingWindow(self.window)
+            self.timings[stage].add(elapsed)
+
+    def count(self, name, amount=1):
+        """ Increments the named counter. """
+        if not self.enabled:
+            return
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def gauge(self, name, func):
+        """ Registers a gauge, whose value is read from `func` whenever the metrics are rendered. """
+        self.gauges[name] = func
+
+    def render(self):
+        """ Renders every metric in the Prometheus text exposition format. """
+        lines = ["# TYPE oncrop_stage_seconds summary"]
+        with self.lock:
+            for stage, window in sorted(self.timings.items()):
+                for q, value in zip(QUANTILES, window.quantiles()):
+                    lines.append('oncrop_stage_seconds{{stage="{}",quantile="{}"}} {:.6g}'.format(stage, q, value))
+                lines.append('oncrop_stage_seconds_sum{{stage="{}"}} {:.6g}'.format(stage, window.total))
+                lines.append('oncrop_stage_seconds_count{{stage="{}"}} {}'.format(stage, window.count))
+
+            for name, value in sorted(self.counters.items()):
+                lines += ["# TYPE {} counter".format(name), "{} {}".format(name, value)]
+
+        for name, func in sorted(self.gauges.items()):
+            lines += ["# TYPE {} gauge".format(name), "{} {}".format(name, func())]
+
+        return "\n".join(lines) + "\n"
+
+
+# The registry shared by the whole process
+metrics = Metrics()
@@ -0,0 +1,125 @@
+"""
+Contains the classes used to serve camera streams asynchronously.
+
+@author: Elias Gabriel, Duncan Mazza
+@revision: v1.0
+"""
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from a2wsgi import WSGIMiddleware
+
+STREAM_FPS = 24  # target frame rate of each asynchronous stream
+STREAM_WORKERS = 32  # number of threads used to composite and encode the frames of the streams
+STREAM_IDLE_TIMEOUT = 10  # seconds a stream waits for a frame before ending, such as when a remote client stops
+LIVE_PREFIX = "/live/"  # path prefix of asynchronously served streams
+PART_HEADER = b"--frame\r\nContent-Type: image/jpeg\r\n\r\n"  # the start of every frame's part of a stream
+
+
+class StreamServer:
+    """
+    An ASGI application that serves MJPEG streams on an event loop instead of a thread per viewer,
+    and hands every other request to the wrapped Flask application.
+
+    Each stream is paced to a target frame rate. Viewers waiting for a frame hold no thread: the
+    engine's source signals the event loop whenever it has a new one, and only compositing and
+    encoding it runs on the executor. Only one frame per viewer is ever in flight: while a slow
+    client's socket buffer is full, the send is awaited and the frames produced in the meantime are
+    skipped, since the engine always hands out the newest one. Disconnects are watched for
+    concurrently, so a viewer that leaves never ties up more than the frame being made for it.
+    """
+
+    def __init__(self, app, fps=STREAM_FPS, workers=STREAM_WORKERS, idle_timeout=STREAM_IDLE_TIMEOUT):
+        self.app = app
+        self.wsgi = WSGIMiddleware(app)
+        self.interval = 1 / fps
+        self.idle_timeout = idle_timeout
+        self.executor = ThreadPoolExecutor(workers, thread_name_prefix="stream")
+
+    async def __call__(self, scope, receive, send):
+        """ Dispatches an ASGI connection to the matching stream, or to the Flask application. """
+        if scope["type"] == "http" and scope["path"].startswith(LIVE_PREFIX):
+            _, engine, release = self.app.streams.pop(scope["path"][len(LIVE_PREFIX):], (None, None, None))
+            if engine is None:
+                await send({"type": "http.response.start", "status": 404, "headers": []})
+                await send({"type": "http.response.body", "body": b""})
+            else:
+                await self.live(engine, release, receive, send)
+        else:
+            await self.wsgi(scope, receive, send)
+
+    async def live(self, engine, release, receive, send):
+        """ Sends the frames of the given engine to the client as multipart chunks until it disconnects,
+        or no frame arrives for `idle_timeout` seconds, then calls `release`. Sources that do not signal
+        their frames never have to be waited for, so they are read whenever the stream is ready. """
+        loop = asyncio.get_running_loop()
+        disconnected = asyncio.ensure_future(self._disconnect(receive))
+        ready = asyncio.Event()  # set by the engine's source, from its own thread, whenever it has a new frame
+        signal = lambda: loop.call_soon_threadsafe(ready.set)
+        watched = engine.watch(signal)
+        pulling = None  # the frame being composited and encoded, which runs on the executor
+
+        try:
+            await send({
+                "type": "http.response.start",
+                "status": 200,
+                "headers": [(b"content-type", b"multipart/x-mixed-replace; boundary=frame"),
+                            (b"cache-control", b"no-cache")]
+            })
+
+            deadline = idle = loop.time()
+            while not disconnected.done():
+                # Wait for a new frame, or for the client to leave, without holding a thread
+                if watched:
+                    waiting = asyncio.ensure_future(ready.wait())
+                    await asyncio.wait([waiting, disconnected], timeout=max(0, idle + self.idle_timeout - loop.time()),
+                                       return_when=asyncio.FIRST_COMPLETED)
+                    if not waiting.done():
+                        waiting.cancel()
+                        break
+                    ready.clear()
+
+                # Composite and encode the frame, which the source already has, so the read never waits
+                pulling = loop.run_in_executor(self.executor, engine.get_frame, 0)
+                await asyncio.wait([pulling, disconnected], return_when=asyncio.FIRST_COMPLETED)
+                if not pulling.done():
+                    break
+                frame, pulling = pulling.result(), None
+                if frame is None:
+                    # The frame was already taken by the last read, or the source has closed
+                    if not watched or loop.time() - idle > self.idle_timeout:
+                        break
+                    continue
+                idle = loop.time()
+
+                # Wait for the chunk to be accepted by the socket, or for the client to leave
+                chunk = b"".join((PART_HEADER, frame, b"\r\n"))
+                sending = asyncio.ensure_future(send({"type": "http.response.body", "body": chunk, "more_body": True}))
+                await asyncio.wait([sending, disconnected], return_when=asyncio.FIRST_COMPLETED)
+                if not sending.done():
+                    sending.cancel()
+                    break
+                sending.result()
+
+                # Pace the stream to the target frame rate, without trying to catch up on late frames
+                deadline += self.interval
+                delay = deadline - loop.time()
+                if delay > 0:
+                    await asyncio.wait([disconnected], timeout=delay)
+                else:
+                    deadline = loop.time()
+        except OSError:
+            pass  # the connection was closed underneath us
+        finally:
+            disconnected.cancel()
+            engine.unwatch(signal)
+            if pulling is not None:
+                # The engine is still making a frame, so let it finish before it is released
+                await asyncio.wait([pulling])
+                pulling.exception()  # mark any failure as seen, since the stream is being closed anyway
+            await loop.run_in_executor(self.executor, release)
+
+    @staticmethod
+    async def _disconnect(receive):
+        """ Returns once the client has disconnected. """
+        while (await receive())["type"] != "http.disconnect":
+            pass
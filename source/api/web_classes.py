@@ -5,26 +5,214 @@ Contains all the classes required to create and launch an application server.
 @revision: v1.0
 """
 from flask import Flask
-from redis import Redis, ConnectionError
+from redis import Redis, BlockingConnectionPool, ConnectionError
 from flask_session import Session
+from flask_session.redis import RedisSessionInterface
+from flask_session.defaults import Defaults
+from collections import OrderedDict
+from functools import cached_property
+from .metrics_classes import metrics
 import subprocess
+import threading
+import secrets
+import time
 import os
 
 
+DETACH_TTL = 30  # seconds a detached stream waits for its client before being closed
+MARKER_TTL = 60 * 60  # seconds a marker ID stays allocated to a session that never releases it
+MARKER_RENEWALS = 3  # times the IDs of live streams are renewed within each TTL, so a late renewal never lets one lapse
+REDIS_CONNECTIONS = 32  # most connections open to Redis at once, shared by sessions, faces, markers and photos
+REDIS_TIMEOUT = 10  # seconds a newly launched Redis server has to become ready
+REDIS_RETRY_DELAY = 0.05  # seconds before the first readiness check of a new Redis server, doubled after each
+REDIS_MAX_DELAY = 1.0  # longest wait (in seconds) between readiness checks
+SESSION_CACHE_TTL = 5  # seconds a session is served from memory before being read from Redis again
+SESSION_CACHE_SIZE = 1024  # maximum number of sessions kept in memory
+SESSION_COUNT_TTL = 10  # seconds the exported number of sessions is reused, since counting them scans every key
 
-def launch_redis():
-	""" Retrieves the running Redis server, or launches one if nothing is running. """
-	rs = Redis('localhost')
 
-	try:
-		# Pings the Redis server. If there is an error, we know there isn't a server running
-		rs.ping()
+
+def launch_redis(host='localhost', timeout=REDIS_TIMEOUT):
+	""" Retrieves the running Redis server, or launches one if nothing is running and waits for it to be
+	ready. Every user of the returned client shares its bounded pool of connections. Raises a RuntimeError
+	if the server could not be started in time. """
+	rs = Redis(connection_pool=BlockingConnectionPool(host=host, max_connections=REDIS_CONNECTIONS))
+
+	def ready():
+		""" Pings the Redis server, which fails if it is not running or is still loading its data. """
+		try: return rs.ping()
+		except ConnectionError: return False
+
+	if ready():
 		return rs
-	except ConnectionError:
-		# Spawn a new process and launch a new Redis server
-		subprocess.Popen(["redis-server"])
-		# Run this function again to return the new server
-		return launch_redis()
+
+	# Spawn a new process and launch a new Redis server
+	try: server = subprocess.Popen(["redis-server"])
+	except OSError as e: raise RuntimeError("Redis is not running, and could not be launched: {}".format(e))
+
+	# Wait for it to accept connections, backing off between checks, unless it exits or takes too long
+	deadline = time.monotonic() + timeout
+	delay = REDIS_RETRY_DELAY
+	while time.monotonic() < deadline:
+		time.sleep(min(delay, max(0, deadline - time.monotonic())))
+		delay = min(2 * delay, REDIS_MAX_DELAY)
+		if ready():
+			return rs
+		if server.poll() is not None:
+			raise RuntimeError("The Redis server exited with code {}.".format(server.returncode))
+	raise RuntimeError("The Redis server was not ready within {} seconds.".format(timeout))
+
+
+
+class CachedSessionInterface(RedisSessionInterface):
+	"""
+	A Redis session interface that keeps recently used sessions in a small in-process LRU, so that
+	requests which only read the session, like those for static files, skip the round trips to Redis.
+	Changed sessions are still written through to Redis at once, but the expiry of an unchanged one is
+	only refreshed once its cached copy expires. Only suitable when a single process serves the
+	application, since changes made by other processes are not seen until then.
+
+	It hooks into the storage methods of Flask-Session's Redis interface, which are private, so
+	setup.py pins Flask-Session to the release series this was written against.
+	"""
+
+	def __init__(self, app, client, max_age=SESSION_CACHE_TTL, max_size=SESSION_CACHE_SIZE, **options):
+		super().__init__(app, client, **options)
+		self.max_age = max_age
+		self.max_size = max_size
+		self.entries = OrderedDict()  # store ID -> (serialized session, when it was last read or written)
+		self.lock = threading.Lock()
+		self.hits = self.misses = 0
+
+	def _retrieve_session_data(self, store_id):
+		""" Returns the decoded session stored under the given ID, from memory if it was used recently. """
+		with self.lock:
+			entry = self.entries.get(store_id)
+			if entry is not None and time.monotonic() - entry[1] < self.max_age:
+				self.hits += 1
+				self.entries.move_to_end(store_id)
+				return self.serializer.decode(entry[0])
+
+		self.misses += 1
+		serialized = self.client.get(store_id)
+		if serialized is None:
+			with self.lock:
+				self.entries.pop(store_id, None)
+			return None
+		self._remember(store_id, serialized)
+		return self.serializer.decode(serialized)
+
+	def _upsert_session(self, session_lifetime, session, store_id):
+		""" Writes the session through to Redis, unless it is unchanged since it was recently stored. """
+		serialized = self.serializer.encode(session)
+		with self.lock:
+			entry = self.entries.get(store_id)
+		if entry is not None and entry[0] == serialized and time.monotonic() - entry[1] < self.max_age:
+			return  # unchanged, and recently enough read or written that its expiry can wait
+
+		self.client.set(name=store_id, value=serialized, ex=int(session_lifetime.total_seconds()))
+		self._remember(store_id, serialized)
+
+	def _delete_session(self, store_id):
+		""" Deletes the session from memory and from Redis. """
+		with self.lock:
+			self.entries.pop(store_id, None)
+		self.client.delete(store_id)
+
+	def _remember(self, store_id, serialized):
+		""" Caches a serialized session, evicting the least recently used one if the cache is full. """
+		with self.lock:
+			self.entries[store_id] = (serialized, time.monotonic())
+			self.entries.move_to_end(store_id)
+			if len(self.entries) > self.max_size:
+				self.entries.popitem(last=False)
+
+
+
+class MarkerAllocator:
+	"""
+	Hands out ARUCO marker IDs to sessions, so that no two sessions hold up the same marker in front of
+	a shared camera. Each ID is claimed with an atomic set-if-absent in Redis, shared by every process,
+	and is freed when its stream ends, or expires on its own if its session is abandoned. The IDs of
+	live streams are held, and renewed on a background thread until released, so that they only expire
+	if the process serving the stream goes away.
+	"""
+
+	def __init__(self, redis, count, ttl=MARKER_TTL):
+		self.redis = redis
+		self.count = count
+		self.ttl = ttl
+		self.interval = ttl / MARKER_RENEWALS  # seconds between renewals of the held IDs
+		self.held = {}  # marker ID -> owner of every ID whose stream is live
+		self.lock = threading.Lock()  # guards the held IDs
+		self.renewer = None
+
+	@staticmethod
+	def key(marker_id):
+		""" Returns the Redis key of a marker ID. """
+		return "marker:{}".format(marker_id)
+
+	def allocate(self, number, owner):
+		""" Claims the given number of free IDs for an owner, lowest first, and returns them. The free IDs
+		are read in one round trip and claimed together in another, which is only repeated for any lost
+		to a concurrent claim. Raises a LookupError if there are not enough free IDs. """
+		ids = []
+		keys = [self.key(marker_id) for marker_id in range(self.count)]
+		while len(ids) < number:
+			free = [marker_id for marker_id, value in enumerate(self.redis.mget(keys)) if value is None]
+			if not free:
+				break
+
+			pipeline = self.redis.pipeline(transaction=False)
+			for marker_id in free[:number - len(ids)]:
+				pipeline.set(keys[marker_id], owner, nx=True, ex=self.ttl)
+			ids += [marker_id for marker_id, claimed in zip(free, pipeline.execute()) if claimed]
+
+		if len(ids) < number:
+			self.release(ids, owner)
+			raise LookupError("There are not enough free markers.")
+		return sorted(ids)
+
+	def hold(self, ids, owner):
+		""" Keeps the given IDs from expiring until they are released, such as while their stream is live. """
+		with self.lock:
+			self.held.update((marker_id, owner) for marker_id in ids)
+			if self.renewer is None:
+				self.renewer = threading.Thread(target=self._renew, name="marker-renewer", daemon=True)
+				self.renewer.start()
+
+	def release(self, ids, owner):
+		""" Frees the given IDs, unless they have since expired and been claimed by another owner. """
+		with self.lock:
+			for marker_id in ids:
+				if self.held.get(marker_id) == owner:
+					self.held.pop(marker_id)
+
+		keys = [self.key(marker_id) for marker_id in ids]
+		if keys:
+			owned = [key for key, value in zip(keys, self.redis.mget(keys)) if value == owner.encode()]
+			if owned:
+				self.redis.delete(*owned)
+
+	def _renew(self):
+		""" Resets the TTL of every held ID still owned by its holder, in two round trips. Runs on a background
+		thread. """
+		while True:
+			time.sleep(self.interval)
+			with self.lock:
+				held = list(self.held.items())
+			if not held:
+				continue
+
+			try:
+				keys = [self.key(marker_id) for marker_id, _ in held]
+				pipeline = self.redis.pipeline(transaction=False)
+				for key, (_, owner), value in zip(keys, held, self.redis.mget(keys)):
+					if value == owner.encode():
+						pipeline.expire(key, self.ttl)
+				pipeline.execute()
+			except ConnectionError:
+				pass  # Redis is unreachable, so try again at the next renewal, well before the IDs expire
 
 
 
@@ -33,21 +221,142 @@ class WebApplication(Flask):
 	A wrapper for a Flask application to simplify app configuration and launching.
 	"""
 
-	def __init__(self, app_name=None, debug=False):
+	def __init__(self, app_name=None, debug=False, source="shared", profile=True, camera=0, redis=None, workers=0,
+				 perspective=False, tracker="aruco", session_cache=False):
 		# Call __init__ from the Flask superclass
 		super().__init__(app_name or __name__)
 
 		# Set configuration variables
 		self.debug = debug
+		self.config['CAMERA_SOURCE'] = source  # `shared` for the server's camera, `remote` for the client's
+		self.config['ASYNC_STREAMING'] = False  # whether streams are served by the asynchronous `StreamServer`
+		self.config['PERSPECTIVE'] = perspective  # whether faces are warped onto the plane of the marker
+		self.config['TRACKER'] = tracker  # `aruco` to track ARUCO markers, or `blob` for pairs of colored dots
+		self.streams = {}  # engines of detached streams waiting for their clients, keyed by token
+		self.engines = {}  # processing engines of the open streams, keyed by stream ID
+		self.camera = camera  # the shared camera, or a function opening a stand-in
+		self.camera_ready = False  # whether the shared camera has been set up, which is left to the first stream
+		self.camera_lock = threading.Lock()  # so that concurrent first streams set it up only once
 		self.config['SESSION_TYPE'] = 'redis'  # for storing data locally
-		self.config['SESSION_REDIS'] = launch_redis()
+		self.config['SESSION_REDIS'] = redis or launch_redis()
 		self.config['SECRET_KEY'] = os.urandom(16)
 		Session(self)  # for the cookies
 
+		# Serve sessions from memory when they are only being read, if asked to, keeping every other setting
+		if session_cache:
+			default = self.session_interface
+			serialization = self.config.get('SESSION_SERIALIZATION_FORMAT', Defaults.SESSION_SERIALIZATION_FORMAT)
+			self.session_interface = CachedSessionInterface(
+				self, self.config['SESSION_REDIS'], key_prefix=default.key_prefix, use_signer=default.use_signer,
+				permanent=default.permanent, sid_length=default.sid_length, serialization_format=serialization)
+
+		# Run the processing engines in worker processes, if asked to. Only needed then, so imported on demand.
+		self.pool = None
+		if workers:
+			from .worker_classes import EnginePool
+			self.pool = EnginePool(workers)
+
+		# Profile the processing pipeline, unless asked not to
+		metrics.enabled = profile
+		metrics.gauge("oncrop_active_streams", lambda: len(self.engines))
+		metrics.gauge("oncrop_redis_sessions", self.count_sessions)
+		metrics.gauge("oncrop_remote_queue_depth", self.queue_depth)
+		self.session_count = None  # (when, number) of the last count of the sessions
+
 	def listen(self, **options):
-		""" Asks Flask to begin listening to HTTP requests, with options if given. """
+		""" Asks Flask to begin listening to HTTP requests, with options if given. If `asynchronous` is
+		set, the application is instead served through an ASGI server, which streams from an event loop. """
 		# If a host is not given, assume localhost
-		self.run(options.get('host', "127.0.0.1"), options.get('port', 3000), options)
+		host, port = options.pop('host', "127.0.0.1"), options.pop('port', 3000)
+
+		if options.pop('asynchronous', False):
+			# Only needed for asynchronous streaming, so imported on demand
+			import uvicorn
+			from .stream_classes import StreamServer, STREAM_FPS
+
+			self.config['ASYNC_STREAMING'] = True
+			uvicorn.run(StreamServer(self, options.get('fps', STREAM_FPS)), host=host, port=port)
+		else:
+			self.run(host, port, options)
+
+	# OpenCV takes a while to import, so the computer vision classes are only imported once a request first
+	# needs them, rather than when the server starts
+
+	@cached_property
+	def faces(self):
+		""" The decoded uploads, backed by the session's Redis server. """
+		from .cv_classes import FaceStore
+		return FaceStore(self.config['SESSION_REDIS'])
+
+	@cached_property
+	def markers(self):
+		""" The allocator of the configured tracker's marker IDs to sessions, through the session's Redis
+		server. """
+		from .cv_classes import marker_count
+		return MarkerAllocator(self.config['SESSION_REDIS'], marker_count(self.config['TRACKER']))
+
+	@cached_property
+	def marker_images(self):
+		""" The configured tracker's markers, rendered on demand. """
+		from .cv_classes import MarkerRenderer
+		return MarkerRenderer(self.config['TRACKER'])
+
+	def setup_camera(self):
+		""" Sets up the process-wide shared camera to open the configured camera and find its markers, unless
+		it has been already. """
+		from .cv_classes import CameraBroadcaster, create_detector
+		with self.camera_lock:
+			if not self.camera_ready:
+				CameraBroadcaster.instance().device = self.camera
+				CameraBroadcaster.instance().detector = create_detector(self.config['TRACKER'], track=True)
+				self.camera_ready = True
+
+	def create_engine(self, source):
+		""" Creates a processing engine for the given camera source, in a worker process if there is a pool. """
+		from .cv_classes import ProcessingEngine
+		if source == "shared":
+			self.setup_camera()
+
+		options = {"perspective": self.config['PERSPECTIVE'], "tracker": self.config['TRACKER']}
+		if self.pool is not None:
+			return self.pool.engine(source, **options)
+		return ProcessingEngine(source=source, **options)
+
+	def release(self, stream, engine, markers=(), owner=None):
+		""" Unregisters the engine of the given stream, and frees its camera and the IDs of the markers its
+		faces were placed on. """
+		if self.engines.get(stream, None) is engine:
+			self.engines.pop(stream)
+		engine.release()
+		if markers:
+			self.markers.release(markers, owner)
+
+	def count_sessions(self):
+		""" Counts the sessions currently stored in Redis, at most once every `SESSION_COUNT_TTL` seconds. """
+		now = time.monotonic()
+		if self.session_count is None or now - self.session_count[0] > SESSION_COUNT_TTL:
+			prefix = self.config.get('SESSION_KEY_PREFIX', "session:")
+			count = sum(1 for _ in self.config['SESSION_REDIS'].scan_iter(match=prefix + "*", count=1000))
+			self.session_count = (now, count)
+		return self.session_count[1]
+
+	def queue_depth(self):
+		""" Counts the frames sent by remote clients that are waiting to be decoded, across every stream. """
+		return sum(getattr(engine.cap, "depth", 0) for engine in list(self.engines.values()))
+
+	def detach(self, engine, release):
+		""" Hands a stream's engine over to the asynchronous `StreamServer`, returning the URL the client
+		should follow to receive it. `release` is called once the stream is over, even if it was
+		never started. """
+		# Close any streams whose clients never arrived, releasing their engines
+		now = time.monotonic()
+		for token, (created, _, stale) in list(self.streams.items()):
+			if now - created > DETACH_TTL and self.streams.pop(token, None):
+				stale()
+
+		token = secrets.token_urlsafe(16)
+		self.streams[token] = (now, engine, release)
+		return "/live/" + token
 
 
 	def route(self, routes):
@@ -0,0 +1,282 @@
+"""
+Contains the classes used to run the processing engines of live streams in worker processes.
+
+@author: Elias Gabriel, Duncan Mazza
+@revision: v1.0
+"""
+import os
+import time
+import itertools
+import threading
+import multiprocessing
+from concurrent.futures import Future, TimeoutError
+from multiprocessing import shared_memory
+import cv2
+import numpy as np
+from .cv_classes import ProcessingEngine, DETECT_EVERY, JPEG_QUALITY
+from .metrics_classes import metrics
+
+RING_SLOTS = 3  # number of frames in each stream's ring buffer, so the last one survives a few more frames
+WORKER_TIMEOUT = 5.0  # seconds to wait for a worker to process a frame before giving up on the stream
+
+
+def _start(target, *args):
+    """ Runs the target in a worker process, once OpenCV has been limited to a single thread. """
+    cv2.setNumThreads(1)  # the processes already use every core, so OpenCV's own threads would only contend
+    target(*args)
+
+
+def spawn_workers(count, target, *args):
+    """ Starts the given number of worker processes running the target, each with its own queue of requests,
+    which are passed to it after the given arguments, followed by a queue of responses that they share.
+    Returns the queues of requests, the queue of responses and the processes. """
+    # Spawn the workers rather than forking them, since OpenCV's thread pools do not survive a fork
+    context = multiprocessing.get_context("spawn")
+    responses = context.Queue()
+    requests = [context.Queue() for _ in range(count)]
+    processes = [context.Process(target=_start, args=(target, *args, queue, responses), daemon=True)
+                 for queue in requests]
+    for process in processes:
+        process.start()
+    return requests, responses, processes
+
+
+class SharedFrames:
+    """
+    The blocks of shared memory a worker process has attached to, each holding one or more frames that
+    are composited there in place. Blocks are looked up by a key of the caller's choosing, like a stream
+    or a slot, and are only ever closed here, since the process that created them unlinks them.
+    """
+
+    def __init__(self):
+        self.blocks = {}  # key -> (block, shape) of every block attached to
+
+    def attach(self, key, name, shape):
+        """ Attaches to the named block holding frames of the given shape, unless it already is. """
+        if key in self.blocks and self.blocks[key][0].name == name:
+            self.blocks[key] = (self.blocks[key][0], shape)
+            return
+        self.detach(key)
+        self.blocks[key] = (shared_memory.SharedMemory(name), shape)
+
+    def detach(self, key):
+        """ Closes the block under the given key, if there is one. """
+        if key in self.blocks:
+            self.blocks.pop(key)[0].close()
+
+    def close(self):
+        """ Closes every block. """
+        for key in list(self.blocks):
+            self.detach(key)
+
+    def process(self, key, engine, index=Ellipsis, corners=None, ids=None, encode=None):
+        """ Has the engine insert its faces into the frame at the given index of a block, in place. If
+        `encode` is given, it is called with the engine once the frame is processed, and the JPEG of the
+        frame is returned if it returns True. Returns None otherwise. """
+        block, shape = self.blocks[key]
+        frame = np.ndarray(shape, np.uint8, block.buf)[index]
+        try:
+            processed = engine.process(frame, corners, ids)
+            if processed is not frame:
+                frame[:] = processed
+            return engine.encode(frame).result() if encode is not None and encode(engine) else None
+        finally:
+            # Drop every view of the block, so that it can be closed
+            engine.last_frame = frame = processed = block = None
+
+
+def _serve(requests, responses):
+    """ Runs the processing engines of the streams assigned to this worker, processing and encoding
+    their frames in shared memory until sent None. Runs in every worker process. """
+    metrics.enabled = False  # only the main process exports metrics
+    engines = {}  # stream -> (engine, whether its uncomposited frames are encoded by the main process)
+    rings = SharedFrames()  # the ring buffer of every stream
+
+    for message in iter(requests.get, None):
+        kind, stream = message[:2]
+        if kind == "open":
+            engines[stream] = (ProcessingEngine(source=None, **message[3]), message[2])
+        elif kind == "face":
+            engines[stream][0].set_faces(message[2])
+        elif kind == "ring":
+            rings.attach(stream, message[2], message[3])
+        elif kind == "frame":
+            _, _, request, slot, corners, ids = message
+            engine, shared = engines[stream]
+            try:
+                # Frames of a shared camera without a face are the same for every viewer, and are
+                # encoded once by the main process instead
+                encoded = rings.process(stream, engine, slot, corners, ids,
+                                        encode=lambda engine: engine.composited or not shared)
+                response = (request, (engine.composited, encoded), None)
+            except Exception as e:
+                response = (request, None, repr(e))
+            responses.put(response)
+        elif kind == "close":
+            engines.pop(stream, None)
+            rings.detach(stream)
+
+    rings.close()
+
+
+class EnginePool:
+    """
+    A pool of worker processes that run the processing engines of live streams, so that compositing
+    uses every core instead of contending for the GIL of the web server's process. Each engine is
+    pinned to a single worker for its whole life, since its motion filters and overlay caches live
+    there, and new engines go to whichever worker has the fewest.
+    """
+
+    def __init__(self, workers=None):
+        self.workers = workers or os.cpu_count()
+        self.load = [0] * self.workers  # number of engines on each worker
+        self.pending = {}  # request -> future of every frame being processed
+        self.ids = itertools.count()
+        self.lock = threading.Lock()
+
+        self.requests, self.responses, self.processes = spawn_workers(self.workers, _serve)
+
+        self.receiver = threading.Thread(target=self._receive, name="engine-pool", daemon=True)
+        self.receiver.start()
+
+    def engine(self, source, **options):
+        """ Creates a processing engine for the given source, which runs on the least loaded worker. """
+        with self.lock:
+            worker = self.load.index(min(self.load))
+            self.load[worker] += 1
+        return PooledEngine(self, worker, source, **options)
+
+    def send(self, worker, message):
+        """ Sends a message to a worker, without waiting for a response. """
+        self.requests[worker].put(message)
+
+    def call(self, worker, kind, stream, *args):
+        """ Sends a request to a worker, returning its ID and a future of its response. """
+        future = Future()
+        request = next(self.ids)
+        with self.lock:
+            self.pending[request] = future
+        self.requests[worker].put((kind, stream, request, *args))
+        return request, future
+
+    def forget(self, request):
+        """ Stops waiting for the response to a request, which is dropped if it ever arrives. """
+        with self.lock:
+            self.pending.pop(request, None)
+
+    def _receive(self):
+        """ Resolves the futures of the frames processed by the workers. Runs on a background thread. """
+        for request, result, error in iter(self.responses.get, None):
+            with self.lock:
+                future = self.pending.pop(request, None)
+            if future is None:
+                continue  # the stream gave up waiting for it
+            if error is not None:
+                future.set_exception(RuntimeError("The frame could not be processed: {}".format(error)))
+            else:
+                future.set_result(result)
+
+    def close(self):
+        """ Stops the workers. """
+        for requests in self.requests:
+            requests.put(None)
+        for process in self.processes:
+            process.join()
+        self.responses.put(None)
+        self.receiver.join()
+
+
+class PooledEngine(ProcessingEngine):
+    """
+    A processing engine whose frames are composited and encoded in a worker process. Frames are still
+    read in this process, then copied into a ring buffer in shared memory, which the worker composites
+    in place before sending back the encoded JPEG. Only the small parts of each request, like the
+    marker corners and the encoded frame, are ever pickled.
+    """
+
+    def __init__(self, pool, worker, source, detect_every=DETECT_EVERY, quality=JPEG_QUALITY, subsampling=None,
+                 perspective=False, tracker="aruco", **options):
+        super().__init__(source, detect_every=detect_every, quality=quality, subsampling=subsampling,
+                         perspective=perspective, tracker=tracker, **options)
+        self.pool = pool
+        self.worker = worker
+        self.id = next(pool.ids)
+        self.ring = None  # the block of shared memory holding the ring buffer
+        self.ring_frames = None
+        self.slot = 0  # the slot the next frame is written into
+        self.encoded = None  # the worker's encoding of the last frame, if it made one
+        self.released = False
+
+        settings = {"detect_every": detect_every, "quality": quality, "subsampling": subsampling,
+                    "perspective": perspective, "tracker": tracker}
+        self.pool.send(worker, ("open", self.id, self.shared, settings))
+
+    def set_faces(self, faces):
+        """ Sets the faces to append, as a mapping from marker IDs to decoded images or the filenames of
+        them. The face under None, if any, is appended to every marker without a face of its own. """
+        super().set_faces(faces)
+        self.pool.send(self.worker, ("face", self.id, self.faces))
+
+    def process(self, frame, corners=None, ids=None):
+        """ Has the worker insert the desired faces into the given frame, returning the processed frame,
+        which lives in the ring buffer until overwritten a few frames later. """
+        assert self.faces, "There must be a face to superimpose."
+        self.frames += 1
+        metrics.count("oncrop_frames_total")
+
+        # Allocate the ring buffer on the first frame, or whenever the frame size changes
+        if self.ring_frames is None or self.ring_frames.shape[1:] != frame.shape:
+            self._release_ring()
+            shape = (RING_SLOTS, *frame.shape)
+            self.ring = shared_memory.SharedMemory(create=True, size=int(np.prod(shape)))
+            self.ring_frames = np.ndarray(shape, np.uint8, self.ring.buf)
+            self.pool.send(self.worker, ("ring", self.id, self.ring.name, shape))
+
+        slot = self.slot
+        self.slot = (slot + 1) % RING_SLOTS
+        self.ring_frames[slot] = frame
+
+        start = time.perf_counter()
+        request, future = self.pool.call(self.worker, "frame", self.id, slot, corners, ids)
+        try:
+            self.composited, self.encoded = future.result(WORKER_TIMEOUT)
+        except TimeoutError:
+            self.pool.forget(request)
+            raise
+        metrics.observe("worker", start)
+
+        self.last_frame = self.ring_frames[slot]
+        return self.last_frame
+
+    def encode(self, frame):
+        """ Returns a future of the processed frame's JPEG byte sequence, which the worker has usually
+        encoded already. """
+        if self.encoded is None:
+            return super().encode(frame)
+        future = Future()
+        future.set_result(self.encoded)
+        return future
+
+    def release(self):
+        """ Releases the capture source, and frees the engine and ring buffer in the worker, exactly once. """
+        with self.pool.lock:
+            if self.released:
+                return
+            self.released = True
+            self.pool.load[self.worker] -= 1
+
+        super().release()
+        self.pool.send(self.worker, ("close", self.id))
+        self._release_ring()
+
+    def _release_ring(self):
+        """ Frees the ring buffer, if there is one. """
+        if self.ring is None:
+            return
+        self.last_frame = self.ring_frames = None
+        self.ring.unlink()
+        try:
+            self.ring.close()
+        except BufferError:
+            pass  # a frame is still being used elsewhere, so the mapping is freed along with it
+        self.ring = None
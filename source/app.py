@@ -4,12 +4,16 @@ A web app interface for dynamic, live facial image insertion.
 @author: Elias Gabriel, Duncan Mazza
 @revision: v1.0
 """
-from flask import render_template, Response, request, session, redirect, jsonify
+from flask import render_template, Response, request, session, redirect, jsonify, current_app, abort, url_for
 from api.web_classes import WebApplication
-from api.cv_classes import ProcessingEngine
-import tempfile
-from random import randint
-import os
+from api.metrics_classes import metrics
+import hashlib
+import secrets
+
+
+CAPTURE_TTL = 60 * 60  # seconds a captured photo is kept
+MAX_FACES = 10  # most faces a single session places at once, each on a marker of its own
+MARKER_MAX_AGE = 365 * 24 * 60 * 60  # seconds a rendered marker may be cached, since it never changes
 
 
 def index(error=False):
@@ -24,17 +28,10 @@ def upload():
 	if not request.method.upper() == "POST" or not images:
 		return index(error=True)
 
-	# Save the uploaded images temporarily server-side, to be used when the  ProcessingEngine
-	# is constructed later
-	session['images'] = []
-
-	# Generate temporary files to store the uploaded images
-	for f in images:
-		# Create a temp file
-		_, tpath = tempfile.mkstemp()
-		# Save the file and path
-		session['images'].append(tpath)
-		f.save(tpath)
+	# Decode the uploaded images once and keep them server-side, to be used when the ProcessingEngine
+	# is constructed later. Only their keys are stored in the session.
+	try: session['images'] = [current_app.faces.put(f.read()) for f in images]
+	except ValueError: return index(error=True)
 
 	# Mark the session as modified, as sessioned mutable objects can be buggy
 	session.modified = True
@@ -44,71 +41,183 @@ def upload():
 
 
 def marker():
-	""" Renders a random pre-generated AURCO marker. """
+	""" Renders an AURCO marker for each uploaded face, which no other session is using. """
 	if not ('images' in session):
 		return index()
 
-	# Render the marker template and randomly select a marker file, set to randmarker variable
-	return render_template('marker.html', randmarker="markers/marker_" + str(randint(0, 9)) + ".jpg")
+	# Allocate a marker to each uploaded face, unless the session already holds as many
+	count = min(len(session['images']), MAX_FACES)
+	if len(session.get('markers', ())) != count:
+		if 'markers' in session:
+			current_app.markers.release(session['markers'], session['marker_owner'])
+		session['marker_owner'] = secrets.token_urlsafe(8)
+		try: session['markers'] = current_app.markers.allocate(count, session['marker_owner'])
+		except LookupError: return index(error=True)
+		session.modified = True
+
+	# Render the marker template with the images of the allocated markers
+	markers = [url_for('marker_image', marker_id=m, fmt="png") for m in session['markers']]
+	return render_template('marker.html', markers=markers, dots=(current_app.config['TRACKER'] == "blob"))
+
+
+def marker_image(marker_id, fmt):
+	""" Serves a marker of the configured tracker, rendered on demand. Since a marker never changes, it can be
+	cached forever. """
+	try: image, etag = current_app.marker_images.render(marker_id, request.args.get('size', type=int), fmt)
+	except ValueError: abort(404)
+
+	response = Response(image, mimetype=("image/png" if fmt == "png" else "image/jpeg"))
+	response.set_etag(etag)
+	response.cache_control.public = True
+	response.cache_control.max_age = MARKER_MAX_AGE
+	response.cache_control.immutable = True
+	return response.make_conditional(request)
 
 
 def snapshot():
 	""" Renders the camera viewpoint. """
 	if not ('images' in session):
 		return index(error=True)
+	# The faces are placed on the markers allocated to the session, so show them first if they have not been
+	if not ('markers' in session):
+		return redirect(url_for('marker'))
 
-	return render_template('snapshot.html')
+	# Identify the stream with an ID unique to this page, which photos are captured from and which
+	# clients of a remote camera source send their own frames to
+	remote = current_app.config['CAMERA_SOURCE'] == "remote"
+	return render_template('snapshot.html', stream=secrets.token_urlsafe(8), remote=remote)
 
 
 def eye():
 	""" Returns a mixed multipart HTTP response containing streamed MJPEG data, pulled from
 	the OpenCV image processor. """
-	# Create a processing engine and register the uploaded face
-	engine = ProcessingEngine(source="local")
-	engine.set_face(session['images'][0])
-	# Clear and delete the cached session images
-	for fpath in session['images']: os.remove(fpath)
+	source = current_app.config['CAMERA_SOURCE']
+	stream = request.args.get('stream', None)
+	if not stream:
+		return index(error=True)
+
+	# Map the uploaded faces to the markers allocated to them
+	markers, owner = session.get('markers', []), session.get('marker_owner')
+	faces = {marker_id: current_app.faces.get(key) for marker_id, key in zip(markers, session.get('images', []))}
+	if not faces or any(face is None for face in faces.values()):
+		return index(error=True)
+
+	# Create a processing engine for the configured camera source and register the uploaded faces
+	engine = current_app.create_engine(source)
+	engine.set_faces(faces)
+	# Clear the session images
 	session.clear()
 
+	# Register the engine under the stream ID, to capture photos and accept remote frames. The
+	# application itself is needed to unregister it, since the stream outlives this request. Its markers are
+	# kept from expiring until then.
+	app = current_app._get_current_object()
+	app.engines[stream] = engine
+	app.markers.hold(markers, owner)
+	release = lambda: app.release(stream, engine, markers, owner)
+
+	# In asynchronous mode, redirect the client to the stream served from the event loop
+	if app.config['ASYNC_STREAMING']:
+		return redirect(app.detach(engine, release))
+
 	# Create and return a mutlipart HTTP response, with the separate parts defined by '--frame'
-	try: return Response(feed(engine), mimetype='multipart/x-mixed-replace; boundary=frame')
+	try: return Response(feed(engine, release), mimetype='multipart/x-mixed-replace; boundary=frame')
 	except: return index(error=True)
 
 
-def feed(engine):
+def frame(stream):
+	""" Receives a single JPEG-encoded camera frame from a remote client, as a raw binary body. """
+	engine = current_app.engines.get(stream, None)
+	if engine is None or not current_app.config['CAMERA_SOURCE'] == "remote" or not request.method == "POST":
+		abort(404)
+
+	engine.cap.write(request.get_data(cache=False))
+	return ('', 204)
+
+
+def feed(engine, release):
 	""" Opens a camera reader, gets a processed frame, encodes it to JPEG, and returns it as a
-	snippet of a multipart response body. """
+	snippet of a multipart response body. Calls `release` once the client disconnects. """
 
 	# In a loop, get the current frame of the camera as a byte sequence and yield it to the calling process.
 	# This lets us send a HTTP response back to the client, but keeps it open to allow for continious
 	# updates. In effect, this streams image data from the server to the client's computer through a
 	# Motion JPEG.
-	# Wrap the encoded frame in a multipart image section, to be inserted into the multipart HTTP response
-	while True: yield(b'--frame\r\nContent-Type: image/jpeg\r\n\r\n' + engine.get_frame() + b'\r\n')
+	# Wrap the encoded frame in a multipart image section, to be inserted into the multipart HTTP response.
+	# Joining the parts copies the encoded frame exactly once.
+	try:
+		for frame in engine.stream(): yield b''.join((b'--frame\r\nContent-Type: image/jpeg\r\n\r\n', frame, b'\r\n'))
+	finally:
+		# The client disconnected, so stop capturing and free the camera
+		release()
 
 
 def capture():
-	""" Passes the exported image data to `show`. """
-	URI = request.form.get('URI', None)
-
-	if not URI or not request.method == "POST":
+	""" Snapshots the latest processed frame of a stream and stores it, to be displayed by `show`. """
+	engine = current_app.engines.get(request.form.get('stream', None), None)
+	if engine is None or not request.method == "POST":
 		return index()
 
-	session['uri'] = URI
+	# Re-encode the frame at full quality, or losslessly if requested
+	image = engine.snapshot(request.form.get('format', "jpeg"))
+	if image is None:
+		return index(error=True)
+
+	# Store the photo once, under an ID derived from its contents
+	capture_id = hashlib.sha1(image).hexdigest()[:16]
+	current_app.config['SESSION_REDIS'].set("capture:" + capture_id, image, ex=CAPTURE_TTL)
+	session['capture'] = capture_id
 	return jsonify(status="success")
 
 
+def image(capture_id):
+	""" Serves a captured photo. Since its ID identifies its contents, it can be cached forever. """
+	image = current_app.config['SESSION_REDIS'].get("capture:" + capture_id)
+	if image is None:
+		abort(404)
+
+	response = Response(image, mimetype=("image/png" if image.startswith(b'\x89PNG') else "image/jpeg"))
+	response.set_etag(capture_id)
+	response.cache_control.private = True
+	response.cache_control.max_age = CAPTURE_TTL
+	response.cache_control.immutable = True
+	return response.make_conditional(request)
+
+
+def prometheus():
+	""" Exposes the metrics of the processing pipeline in the Prometheus text format. """
+	if not metrics.enabled:
+		abort(404)
+	return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+
 def show():
 	"""
 	Displays the captured photo, and prompts the user to either take another photo or start again.
 	"""
-	if not ('uri' in session):
+	if not ('capture' in session):
 		return index(error=True)
 
-	uri = session['uri']
+	capture_id = session['capture']
 	session.clear()
-	return render_template('show.html', captured_img=uri)
+	return render_template('show.html', captured_img=url_for('image', capture_id=capture_id))
+
+
 
+# The application routes
+ROUTES = {
+	'/': index,
+	'/eye': eye,
+	'/frame/<stream>': frame,
+	'/upload': upload,
+	'/marker': marker,
+	'/markers/<int:marker_id>.<fmt>': marker_image,
+	'/snapshot': snapshot,
+	'/capture': capture,
+	'/image/<capture_id>': image,
+	'/show': show,
+	'/metrics': prometheus
+}
 
 
 # Only start the server if the script is run directly
@@ -116,15 +225,7 @@ if __name__ == "__main__":
 	# Create a new web application
 	app = WebApplication("cropmeon")
 	# Define the application routes
-	app.route({
-		'/': index,
-		'/eye': eye,
-		'/upload': upload,
-		'/marker': marker,
-		'/snapshot': snapshot,
-		'/capture': capture,
-		'/show': show
-	})
+	app.route(ROUTES)
 
 	# Beginning listening on `localhost`, port 3000
 	app.listen(port=8080, env="development")
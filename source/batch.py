@@ -0,0 +1,44 @@
+"""
+A command line interface for compositing a face into recorded videos and sets of photos offline.
+
+	$ python batch.py face.png recording.mp4 composited.mp4
+	$ python batch.py face.png photos/ composited/ --workers 8
+
+@author: Elias Gabriel, Duncan Mazza
+@revision: v1.0
+"""
+from api.batch_classes import ProcessingPool, CHUNK_FRAMES
+from api.cv_classes import FaceStore
+import argparse
+import os
+import time
+import cv2
+
+
+# Only run if the script is run directly, since the workers import it again when they are spawned
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description="Composites a face into a video, or a directory of images.")
+	parser.add_argument("face", help="the image of the face to insert")
+	parser.add_argument("input", help="a video, or a directory of images containing markers")
+	parser.add_argument("output", help="the video, or directory, to write the results to")
+	parser.add_argument("--workers", type=int, default=os.cpu_count(), help="number of worker processes")
+	parser.add_argument("--chunk", type=int, default=CHUNK_FRAMES, help="consecutive video frames per worker")
+	parser.add_argument("--perspective", action="store_true", help="warp the face onto the plane of the marker")
+	parser.add_argument("--tracker", choices=("aruco", "blob"), default="aruco",
+						help="track ARUCO markers, or pairs of colored dots")
+	args = parser.parse_args()
+
+	face = cv2.imread(args.face, cv2.IMREAD_UNCHANGED)
+	if face is None:
+		parser.error("Unable to read the face `{}`.".format(args.face))
+
+	start = time.perf_counter()
+	with ProcessingPool(FaceStore.prepare(face), args.workers, args.chunk, args.perspective, args.tracker) as pool:
+		if os.path.isdir(args.input):
+			count = pool.process_images(args.input, args.output)
+		else:
+			count = pool.process_video(args.input, args.output)
+	elapsed = time.perf_counter() - start
+
+	print("Composited {} frames in {:.1f} s ({:.1f} fps) with {} workers.".format(
+		count, elapsed, count / elapsed, args.workers))
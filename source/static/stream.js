@@ -0,0 +1,33 @@
+/**
+Streams the client's own camera to the server, for the remote camera source.
+
+@author: Elias Gabriel, Duncan Mazza
+@revision: v1.0
+**/
+const FRAME_ENDPOINT = '/frame/';
+const FRAME_QUALITY = 0.8;
+
+let camera = document.getElementById('camera');
+let frameCanvas = document.createElement('canvas');
+
+function sendFrame() {
+	/* Encodes the current camera image as a JPEG and posts it as a raw binary body. The next frame
+	is only sent once the server has accepted this one, so a slow connection sends fewer frames
+	instead of queueing them. */
+	frameCanvas.width = camera.videoWidth;
+	frameCanvas.height = camera.videoHeight;
+	frameCanvas.getContext('2d').drawImage(camera, 0, 0);
+
+	frameCanvas.toBlob(blob => {
+		fetch(FRAME_ENDPOINT + camera.dataset.stream, {
+			method: 'POST',
+			headers: {'Content-Type': 'image/jpeg'},
+			body: blob
+		}).catch(() => null).then(() => requestAnimationFrame(sendFrame));
+	}, 'image/jpeg', FRAME_QUALITY);
+}
+
+navigator.mediaDevices.getUserMedia({video: true, audio: false}).then(media => {
+	camera.srcObject = media;
+	camera.onloadedmetadata = () => sendFrame();
+});